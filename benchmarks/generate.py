@@ -0,0 +1,497 @@
+import os
+import sys
+import optparse
+import random
+import sqlite3
+import struct
+import uuid
+import zlib
+
+from biplist import writePlistToString
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program generates a synthetic NoteStore.sqlite with the
+# ZICNOTEDATA/ZICCLOUDSYNCINGOBJECT layout read by readnotes.py.
+#
+# Note bodies, drawings and tables are encoded with the same protobuf
+# schemas that notes2html.py decodes (s_doc, s_drawing and s_table).
+#
+# If the output file is named like NotesV6.storedata an older Notes database
+# is generated instead, with ZNOTE/ZNOTEBODY/ZFOLDER/ZACCOUNT/ZATTACHMENT
+# tables, HTML bodies and file URLs archived in binary plists.
+#
+
+__version__ = '1.00'
+
+# protobuf encoder (the inverse of notes2html.parse)
+
+def uvarint(n):
+  out = bytearray()
+  while True:
+    b = n & 0x7f
+    n >>= 7
+    if n:
+      out.append(b | 0x80)
+    else:
+      out.append(b)
+      return bytes(out)
+
+def field_varint(key, value):
+  return uvarint(key << 3) + uvarint(value)
+
+def field_bytes(key, value):
+  if isinstance(value, str):
+    value = value.encode('utf8')
+  return uvarint((key << 3) | 2) + uvarint(len(value)) + value
+
+def field_float(key, value):
+  return uvarint((key << 3) | 5) + struct.pack('<f', value)
+
+def message(*fields):
+  return b''.join(fields)
+
+def versioned(data):
+  "Wrap a document in the version/data envelope shared by all schemas"
+  return field_bytes(2, field_bytes(3, data))
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua ut enim ad minim '
+         'veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea '
+         'commodo consequat café naïve über').split()
+
+ATTACHMENT_CHAR = '￼'
+
+def random_text(rng, size):
+  words = []
+  length = 0
+  while length < size:
+    w = rng.choice(WORDS)
+    words.append(w)
+    length += len(w) + 1
+  return ' '.join(words)[:size]
+
+def encode_string(text, runs):
+  "Encode an attributed string; runs is a list of (length, attributes) tuples"
+  fields = [field_bytes(2, text)]
+  for length, attrs in runs:
+    run = [field_varint(1, length)]
+    style = attrs.get('style')
+    if style is not None:
+      run.append(field_bytes(2, message(field_varint(1, style), field_varint(4, attrs.get('indent', 0)))))
+    for key, name in ((5, 'fontHints'), (6, 'underline'), (7, 'strikethrough')):
+      if attrs.get(name):
+        run.append(field_varint(key, attrs[name]))
+    if attrs.get('link'):
+      run.append(field_bytes(9, attrs['link']))
+    if attrs.get('attachment'):
+      identifier, uti = attrs['attachment']
+      run.append(field_bytes(12, message(field_bytes(1, identifier), field_bytes(2, uti))))
+    fields.append(field_bytes(5, message(*run)))
+  return message(*fields)
+
+def make_note_body(rng, body_size, run_count, attachments):
+  "Returns the protobuf for a note body with run_count formatted runs and the given inline attachments"
+  remaining = max(run_count, 1)
+  per_run = max(body_size // remaining, 1)
+  text = ''
+  runs = []
+  styles = [None, None, None, 0, 1, 100, 102]
+  while remaining > 0:
+    frag = random_text(rng, per_run)
+    attrs = {}
+    style = rng.choice(styles)
+    if style is not None:
+      attrs['style'] = style
+    attrs['fontHints'] = rng.choice((0, 0, 1, 2, 3))
+    attrs['underline'] = rng.choice((0, 0, 0, 1))
+    attrs['strikethrough'] = rng.choice((0, 0, 0, 1))
+    if rng.random() < 0.05:
+      attrs['link'] = 'https://example.com/' + frag.split(' ')[0]
+    if rng.random() < 0.3:
+      frag += '\n'
+    text += frag
+    runs.append((len(frag), attrs))
+    remaining -= 1
+  for identifier, uti in attachments:
+    text += ATTACHMENT_CHAR
+    runs.append((1, {'attachment': (identifier, uti)}))
+    frag = ' ' + random_text(rng, 12) + '\n'
+    text += frag
+    runs.append((len(frag), {}))
+  return versioned(encode_string(text, runs))
+
+def make_drawing(rng, strokes, points):
+  "Returns the protobuf for a drawing with the given stroke and point counts"
+  inks = [
+    message(field_bytes(1, message(field_float(1, 0.2), field_float(2, 0.4), field_float(3, 0.6), field_float(4, 1.0))),
+            field_bytes(2, 'com.apple.ink.pen')),
+    message(field_bytes(1, message(field_float(1, 1.0), field_float(2, 0.9), field_float(3, 0.1), field_float(4, 1.0))),
+            field_bytes(2, 'com.apple.ink.marker')),
+  ]
+  fields = [field_bytes(4, ink) for ink in inks]
+  for s in range(strokes):
+    x = rng.uniform(0, 768)
+    y = rng.uniform(0, 1024)
+    buf = bytearray()
+    for p in range(points):
+      x += rng.uniform(-4, 4)
+      y += rng.uniform(-4, 4)
+      buf += struct.pack('<3f5H2B', p * 0.01, x, y, 0, 0, 0, 0, 0, 0, 0)
+    stroke = [field_varint(3, s % len(inks)), field_bytes(5, bytes(buf))]
+    if s % 17 == 16:
+      stroke.append(field_varint(9, 1))
+    if s % 5 == 4:
+      stroke.append(field_bytes(10, message(field_float(1, 1.0), field_float(2, 0.0), field_float(3, 0.0),
+                                            field_float(4, 1.0), field_float(5, 10.5), field_float(6, -3.25))))
+    fields.append(field_bytes(5, message(*stroke)))
+  fields.append(field_bytes(8, message(field_float(1, 0.0), field_float(2, 0.0), field_float(3, 768.0), field_float(4, 1024.0))))
+  return versioned(message(*fields))
+
+def make_table(rng, rows, columns):
+  "Returns the protobuf for a CRArchive table with rows x columns plain text cells"
+  key_items = ['crRows', 'crColumns', 'cellColumns', 'UUIDIndex']
+  type_items = ['com.apple.notes.ICTable', 'com.apple.CRDT.NSUUID']
+  uuid_items = []
+  objects = [None, None, None, None]
+
+  def oid_object(index):
+    return field_varint(6, index)
+
+  def oid_int(value):
+    return field_varint(2, value)
+
+  def add_object(data):
+    objects.append(data)
+    return len(objects) - 1
+
+  def add_uuid():
+    uuid_items.append(uuid.UUID(int=rng.getrandbits(128)).bytes)
+    entry = message(field_varint(1, 3), field_bytes(2, oid_int(len(uuid_items) - 1)))
+    return add_object(field_bytes(13, message(field_varint(1, 1), field_bytes(3, entry))))
+
+  def element(key, value):
+    return field_bytes(1, message(field_bytes(1, oid_object(key)), field_bytes(2, oid_object(value))))
+
+  def ordered_set(uuid_objects):
+    attachments = []
+    contents = []
+    for i, obj in enumerate(uuid_objects):
+      index = len(uuid_items) - len(uuid_objects) + i
+      attachments.append(field_bytes(2, message(field_varint(1, i), field_bytes(2, uuid_items[index]))))
+      contents.append(element(obj, obj))
+    array = field_bytes(1, message(field_bytes(1, encode_string('', [])), *attachments))
+    ordering = field_bytes(1, message(array, field_bytes(2, message(*contents))))
+    return field_bytes(16, message(ordering, field_bytes(2, message(*contents))))
+
+  row_uuids = [add_uuid() for _ in range(rows)]
+  objects[1] = ordered_set(row_uuids)
+  column_uuids = [add_uuid() for _ in range(columns)]
+  objects[2] = ordered_set(column_uuids)
+
+  cell_columns = []
+  for c in column_uuids:
+    cells = []
+    for r in row_uuids:
+      text = random_text(rng, rng.randint(3, 24))
+      cell = add_object(field_bytes(10, encode_string(text, [(len(text), {'fontHints': rng.choice((0, 1))})])))
+      cells.append(element(r, cell))
+    cell_columns.append(element(c, add_object(field_bytes(6, message(*cells)))))
+  objects[3] = field_bytes(6, message(*cell_columns))
+
+  map_entries = [field_bytes(3, message(field_varint(1, k), field_bytes(2, oid_object(v)))) for k, v in ((0, 1), (1, 2), (2, 3))]
+  objects[0] = field_bytes(13, message(field_varint(1, 0), *map_entries))
+
+  fields = [field_bytes(3, obj) for obj in objects]
+  fields += [field_bytes(4, k) for k in key_items]
+  fields += [field_bytes(5, t) for t in type_items]
+  fields += [field_bytes(6, u) for u in uuid_items]
+  return versioned(message(*fields))
+
+# NoteStore.sqlite writer
+
+def create_notestore(sqlconn):
+  sqlconn.execute('''CREATE TABLE ZICNOTEDATA (
+  Z_PK INTEGER PRIMARY KEY,
+  Z_ENT INTEGER,
+  Z_OPT INTEGER,
+  ZNOTE INTEGER,
+  ZCRYPTOTAG BLOB,
+  ZDATA BLOB
+  );''')
+  sqlconn.execute('''CREATE TABLE ZICCLOUDSYNCINGOBJECT (
+  Z_PK INTEGER PRIMARY KEY,
+  Z_ENT INTEGER,
+  Z_OPT INTEGER,
+  ZACCOUNT2 INTEGER,
+  ZACCOUNT3 INTEGER,
+  ZACCOUNTTYPE INTEGER,
+  ZATTACHMENT1 INTEGER,
+  ZFOLDER INTEGER,
+  ZMEDIA INTEGER,
+  ZNOTE INTEGER,
+  ZNOTEDATA INTEGER,
+  ZCREATIONDATE1 TIMESTAMP,
+  ZLASTVIEWEDMODIFICATIONDATE TIMESTAMP,
+  ZMODIFICATIONDATE1 TIMESTAMP,
+  ZFILESIZE INTEGER,
+  ZCRYPTOTAG BLOB,
+  ZFILENAME VARCHAR,
+  ZIDENTIFIER VARCHAR,
+  ZMERGEABLEDATA BLOB,
+  ZNAME VARCHAR,
+  ZSNIPPET VARCHAR,
+  ZTITLE VARCHAR,
+  ZTITLE1 VARCHAR,
+  ZTITLE2 VARCHAR,
+  ZTYPEUTI VARCHAR,
+  ZURLSTRING VARCHAR
+  );''')
+
+class NoteStoreGenerator:
+  '''Writes synthetic accounts, folders, notes and attachments'''
+
+  def __init__(self, sqlconn, seed=0):
+    self.sqlconn = sqlconn
+    self.rng = random.Random(seed)
+    self.next_pk = 1
+
+  def identifier(self):
+    return str(uuid.UUID(int=self.rng.getrandbits(128))).upper()
+
+  def insert_object(self, **values):
+    pk = self.next_pk
+    self.next_pk += 1
+    values['Z_PK'] = pk
+    names = ', '.join(values.keys())
+    marks = ', '.join('?' * len(values))
+    self.sqlconn.execute('INSERT INTO ZICCLOUDSYNCINGOBJECT (%s) VALUES (%s)' % (names, marks), tuple(values.values()))
+    return pk
+
+  def generate(self, options):
+    rng = self.rng
+    account = self.insert_object(ZNAME='iCloud', ZIDENTIFIER=self.identifier(), ZACCOUNTTYPE=1)
+    folders = [self.insert_object(ZTITLE2='Folder %d' % (i,), ZIDENTIFIER=self.identifier(), ZACCOUNT3=account)
+               for i in range(max(options.folders, 1))]
+    created = 600000000.0
+    for n in range(options.notes):
+      note = self.insert_object(ZTITLE1='Note %d %s' % (n, random_text(rng, 24)), ZSNIPPET=random_text(rng, 60),
+                                ZIDENTIFIER=self.identifier(), ZFOLDER=rng.choice(folders), ZACCOUNT2=account,
+                                ZCREATIONDATE1=created + n, ZMODIFICATIONDATE1=created + n + rng.randint(0, 86400),
+                                ZLASTVIEWEDMODIFICATIONDATE=created + n)
+      inline = []
+      for a in range(options.attachments):
+        kind = a % 3
+        identifier = self.identifier()
+        if kind == 0:
+          att = self.insert_object(ZNOTE=note, ZIDENTIFIER=identifier, ZTYPEUTI='public.jpeg', ZFILESIZE=rng.randint(1000, 100000))
+          self.insert_object(ZIDENTIFIER=self.identifier(), ZFILENAME='IMG_%04d.jpeg' % (a,), ZATTACHMENT1=att)
+          self.sqlconn.execute('UPDATE ZICCLOUDSYNCINGOBJECT SET ZMEDIA = ? WHERE Z_PK = ?', (att + 1, att))
+          inline.append((identifier, 'public.jpeg'))
+        elif kind == 1:
+          self.insert_object(ZNOTE=note, ZIDENTIFIER=identifier, ZTYPEUTI='public.url',
+                             ZURLSTRING='https://example.com/%d/%d' % (n, a), ZTITLE='Link %d' % (a,))
+          inline.append((identifier, 'public.url'))
+        else:
+          att = self.insert_object(ZNOTE=note, ZIDENTIFIER=identifier, ZTYPEUTI='com.adobe.pdf', ZFILESIZE=rng.randint(1000, 100000))
+          self.insert_object(ZIDENTIFIER=self.identifier(), ZFILENAME='Document %d.pdf' % (a,), ZATTACHMENT1=att)
+          self.sqlconn.execute('UPDATE ZICCLOUDSYNCINGOBJECT SET ZMEDIA = ? WHERE Z_PK = ?', (att + 1, att))
+          inline.append((identifier, 'com.adobe.pdf'))
+      for d in range(options.drawings):
+        identifier = self.identifier()
+        data = zlib.compress(make_drawing(rng, options.strokes, options.points))
+        self.insert_object(ZNOTE=note, ZIDENTIFIER=identifier, ZTYPEUTI='com.apple.drawing', ZMERGEABLEDATA=data)
+        inline.append((identifier, 'com.apple.drawing'))
+      for t in range(options.tables):
+        identifier = self.identifier()
+        data = zlib.compress(make_table(rng, options.table_rows, options.table_columns))
+        self.insert_object(ZNOTE=note, ZIDENTIFIER=identifier, ZTYPEUTI='com.apple.notes.table', ZMERGEABLEDATA=data)
+        inline.append((identifier, 'com.apple.notes.table'))
+      body = make_note_body(rng, options.body_size, options.runs, inline)
+      cursor = self.sqlconn.execute('INSERT INTO ZICNOTEDATA (ZNOTE, ZDATA) VALUES (?, ?)', (note, zlib.compress(body)))
+      self.sqlconn.execute('UPDATE ZICCLOUDSYNCINGOBJECT SET ZNOTEDATA = ? WHERE Z_PK = ?', (cursor.lastrowid, note))
+
+# NotesVx.storedata writer
+
+def create_storedata(sqlconn):
+  sqlconn.execute('''CREATE TABLE ZACCOUNT (
+  Z_PK INTEGER PRIMARY KEY,
+  ZACCOUNTDESCRIPTION VARCHAR,
+  ZEMAILADDRESS VARCHAR,
+  ZUSERNAME VARCHAR
+  );''')
+  sqlconn.execute('''CREATE TABLE ZFOLDER (
+  Z_PK INTEGER PRIMARY KEY,
+  ZACCOUNT INTEGER,
+  ZPARENT INTEGER,
+  ZNAME VARCHAR
+  );''')
+  sqlconn.execute('''CREATE TABLE ZNOTE (
+  Z_PK INTEGER PRIMARY KEY,
+  ZFOLDER INTEGER,
+  ZDATECREATED TIMESTAMP,
+  ZDATEEDITED TIMESTAMP,
+  ZTITLE VARCHAR
+  );''')
+  sqlconn.execute('''CREATE TABLE ZNOTEBODY (
+  Z_PK INTEGER PRIMARY KEY,
+  ZNOTE INTEGER,
+  ZHTMLSTRING VARCHAR
+  );''')
+  sqlconn.execute('''CREATE TABLE ZATTACHMENT (
+  Z_PK INTEGER PRIMARY KEY,
+  ZNOTE INTEGER,
+  ZCONTENTID VARCHAR,
+  ZFILEURL BLOB
+  );''')
+
+def archived_url(path):
+  "Returns a keyed archive of an NSURL, with the path at $objects[2] as ReadAttPathFromPlist expects"
+  return writePlistToString({
+    '$archiver': 'NSKeyedArchiver',
+    '$version': 100000,
+    '$top': {'root': 1},
+    '$objects': ['$null', {'NS.relative': 2}, path],
+  })
+
+def generate_storedata(sqlconn, options):
+  '''Writes accounts with nested folders, notes, bodies and attachments.
+
+  Notes are also filed in the accounts' top level folders (which have no
+  parent, so no account), in missing folders and without a body; some
+  attachments share a file URL or have none.
+  '''
+  rng = random.Random(options.seed)
+  folders = []
+  for a in range(2):
+    account = sqlconn.execute('''INSERT INTO ZACCOUNT (ZACCOUNTDESCRIPTION, ZEMAILADDRESS, ZUSERNAME) VALUES (?, ?, ?)''',
+      ('Account %d' % (a,), 'user%d@example.com' % (a,), 'user%d' % (a,))).lastrowid
+    top = sqlconn.execute('''INSERT INTO ZFOLDER (ZACCOUNT, ZNAME) VALUES (?, ?)''', (account, 'Account %d' % (a,))).lastrowid
+    folders.append(top)
+    for f in range(max(options.folders, 1)):
+      folder = sqlconn.execute('''INSERT INTO ZFOLDER (ZACCOUNT, ZPARENT, ZNAME) VALUES (?, ?, ?)''',
+        (account, top, 'Folder %d.%d' % (a, f))).lastrowid
+      folders.append(folder)
+      folders.append(sqlconn.execute('''INSERT INTO ZFOLDER (ZPARENT, ZNAME) VALUES (?, ?)''',
+        (folder, 'Subfolder %d.%d' % (a, f))).lastrowid)
+  folders.append(None)
+  folders.append(10000)
+  shared_url = archived_url('/Users/user/Library/Mail/Attachments/shared.pdf')
+  created = 400000000.0
+  for n in range(options.notes):
+    note = sqlconn.execute('''INSERT INTO ZNOTE (ZFOLDER, ZDATECREATED, ZDATEEDITED, ZTITLE) VALUES (?, ?, ?, ?)''',
+      (rng.choice(folders), created + n, created + n + rng.randint(0, 86400), 'Note %d %s' % (n, random_text(rng, 24)))).lastrowid
+    if rng.random() < 0.95:
+      body = '<div>%s</div>' % ('</div><div>'.join(random_text(rng, options.body_size // options.runs + 1) for r in range(options.runs)),)
+      sqlconn.execute('''INSERT INTO ZNOTEBODY (ZNOTE, ZHTMLSTRING) VALUES (?, ?)''', (note, body))
+    for a in range(rng.randint(0, options.attachments * 2)):
+      kind = rng.random()
+      if kind < 0.2:
+        url = None
+      elif kind < 0.4:
+        url = shared_url
+      else:
+        url = archived_url('/Users/user/Library/Notes/Attachments/%d/file%d.jpeg' % (n, a))
+      sqlconn.execute('''INSERT INTO ZATTACHMENT (ZNOTE, ZCONTENTID, ZFILEURL) VALUES (?, ?, ?)''',
+        (note, '%s@example.com' % (uuid.UUID(int=rng.getrandbits(128)),), url))
+
+def is_storedata(path):
+  name = os.path.basename(path)
+  return any(name.find(version) > 0 for version in ('V1', 'V2', 'V4', 'V6', 'V7'))
+
+def generate_notestore(path, options):
+  if os.path.exists(path):
+    os.remove(path)
+  sqlconn = sqlite3.connect(path)
+  if is_storedata(path):
+    create_storedata(sqlconn)
+    generate_storedata(sqlconn, options)
+  else:
+    create_notestore(sqlconn)
+    NoteStoreGenerator(sqlconn, options.seed).generate(options)
+  sqlconn.commit()
+  sqlconn.close()
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--output",
+                    action="store", dest="output_path", default=None,
+                    help="Path to the NoteStore.sqlite (or NotesVx.storedata) file to generate")
+  parser.add_option("", "--notes",
+                    action="store", dest="notes", type="int", default=1000,
+                    help="Number of notes")
+  parser.add_option("", "--folders",
+                    action="store", dest="folders", type="int", default=5,
+                    help="Number of folders")
+  parser.add_option("", "--body-size",
+                    action="store", dest="body_size", type="int", default=2000,
+                    help="Approximate note body size in characters")
+  parser.add_option("", "--runs",
+                    action="store", dest="runs", type="int", default=20,
+                    help="Attribute runs per note body")
+  parser.add_option("", "--attachments",
+                    action="store", dest="attachments", type="int", default=1,
+                    help="File and URL attachments per note")
+  parser.add_option("", "--drawings",
+                    action="store", dest="drawings", type="int", default=0,
+                    help="Drawings per note")
+  parser.add_option("", "--strokes",
+                    action="store", dest="strokes", type="int", default=50,
+                    help="Strokes per drawing")
+  parser.add_option("", "--points",
+                    action="store", dest="points", type="int", default=50,
+                    help="Points per stroke")
+  parser.add_option("", "--tables",
+                    action="store", dest="tables", type="int", default=0,
+                    help="Tables per note")
+  parser.add_option("", "--table-rows",
+                    action="store", dest="table_rows", type="int", default=5,
+                    help="Rows per table")
+  parser.add_option("", "--table-columns",
+                    action="store", dest="table_columns", type="int", default=4,
+                    help="Columns per table")
+  parser.add_option("", "--seed",
+                    action="store", dest="seed", type="int", default=0,
+                    help="Random seed")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if not options.output_path:
+    parser.error("output path not specified.")
+
+  outputPath = os.path.abspath(os.path.expanduser(options.output_path))
+  generate_notestore(outputPath, options)
+  print("generated '%s'" % (outputPath,))
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
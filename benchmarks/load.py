@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import optparse
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program loads the same synthetic mac_apt rows into a new mac_apt.db
+# with the default settings and with each bulk-load journal mode, and reports
+# the load time, the time spent building indexes and running ANALYZE at the
+# end, rows/s and the size of the database. With --codec the Data column is
+# compressed, and the compression time and savings are reported as well.
+#
+#   python3 -m benchmarks.load --rows 100000 --json load.json
+#   python3 -m benchmarks.load --rows 100000 --codec zlib
+#
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import notesdb
+from benchmarks.generate import random_text
+
+__version__ = '1.00'
+
+PROFILES = ['default'] + ['bulk-' + mode.lower() for mode in notesdb.BulkLoad.JOURNAL_MODES]
+
+def make_rows(rows, data_size, seed):
+  "Returns mac_apt column dicts, several rows per note as for notes with attachments"
+  rng = random.Random(seed)
+  result = []
+  note_id = 0
+  while len(result) < rows:
+    note_id += 1
+    data = '<div>%s</div>' % (random_text(rng, data_size),)
+    for attachment in range(rng.randint(1, 3)):
+      result.append({
+        'apple_id': note_id,
+        'apple_title': 'Note %d' % (note_id,),
+        'apple_snippet': data[5:60],
+        'apple_folder': 'Folder %d' % (note_id % 20,),
+        'apple_created': '2020-01-01 00:00:00',
+        'apple_last_modified': '2020-01-02 00:00:00',
+        'apple_data': data,
+        'apple_attachment_id': str(attachment),
+        'apple_attachment_path': '',
+        'apple_account_description': 'iCloud',
+        'apple_account_identifier': 'account',
+        'apple_account_username': '',
+        'apple_version': 'NoteStore',
+        'apple_user': 'bench',
+        'apple_source': 'NoteStore.sqlite',
+      })
+  return result[:rows]
+
+def load(path, rows, profile, batch_size, codec=None):
+  "Returns tuple (load seconds, finish seconds, writer)"
+  sqlconn = sqlite3.connect(path)
+  try:
+    bulk = None
+    started = time.perf_counter()
+    if profile == 'default':
+      notesdb.create_macapt_database(sqlconn)
+    else:
+      notesdb.create_macapt_database(sqlconn, indexes=False)
+      bulk = notesdb.BulkLoad(sqlconn, notesdb.MACAPT_INDEXES, profile[len('bulk-'):].upper())
+      bulk.begin()
+    writer = notesdb.MacAptNoteBatch(sqlconn, batch_size, codec=codec)
+    for columns in rows:
+      writer.add(columns)
+    writer.flush()
+    loaded = time.perf_counter()
+    if bulk is not None:
+      bulk.finish()
+    finished = time.perf_counter()
+  finally:
+    sqlconn.close()
+  return loaded - started, finished - loaded, writer
+
+def benchmark(rows, repeat, batch_size, codec=None):
+  profiles = {}
+  directory = tempfile.mkdtemp(prefix='load')
+  try:
+    for profile in PROFILES:
+      best = None
+      for i in range(repeat):
+        path = os.path.join(directory, 'mac_apt.db')
+        for suffix in ('', '-wal', '-shm', '-journal'):
+          if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+        loaded, finished, writer = load(path, rows, profile, batch_size, codec)
+        if best is None or loaded + finished < best[0] + best[1]:
+          best = (loaded, finished, writer, os.path.getsize(path))
+      total = best[0] + best[1]
+      profiles[profile] = {
+        'load_seconds': best[0],
+        'finish_seconds': best[1],
+        'seconds': total,
+        'rows_per_second': len(rows) / total if total > 0 else None,
+        'database_bytes': best[3],
+      }
+      if codec is not None:
+        writer = best[2]
+        profiles[profile]['compress_seconds'] = writer.compress_seconds
+        profiles[profile]['raw_bytes'] = writer.raw_bytes
+        profiles[profile]['stored_bytes'] = writer.stored_bytes
+  finally:
+    shutil.rmtree(directory)
+  return profiles
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--rows",
+                    action="store", dest="rows", type="int", default=20000,
+                    help="Number of rows loaded")
+  parser.add_option("", "--data-size",
+                    action="store", dest="data_size", type="int", default=2000,
+                    help="Approximate size in characters of each row's HTML")
+  parser.add_option("", "--batch-size",
+                    action="store", dest="batch_size", type="int", default=1000,
+                    help="Rows inserted per transaction, as readnotes --batch-size")
+  parser.add_option("", "--codec",
+                    action="store", dest="codec", default=None,
+                    help="Compress the Data column with this codec")
+  parser.add_option("", "--repeat",
+                    action="store", dest="repeat", type="int", default=3,
+                    help="Number of timed loads per profile")
+  parser.add_option("", "--seed",
+                    action="store", dest="seed", type="int", default=1,
+                    help="Random seed")
+  parser.add_option("", "--json",
+                    action="store", dest="json_path", default=None,
+                    help="Path to JSON results file")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if options.rows < 1:
+    parser.error("rows must be at least 1.")
+  if options.batch_size < 1:
+    parser.error("batch size must be at least 1.")
+  if options.repeat < 1:
+    parser.error("repeat must be at least 1.")
+  if options.codec is not None and options.codec not in notesdb.available_codecs():
+    parser.error("codec must be one of: %s." % (', '.join(notesdb.available_codecs()),))
+
+  rows = make_rows(options.rows, options.data_size, options.seed)
+  profiles = benchmark(rows, options.repeat, options.batch_size, options.codec)
+  baseline = profiles['default']['seconds']
+  for name in PROFILES:
+    stats = profiles[name]
+    line = "load %-8s %d row(s), load %.3fs, finish %.3fs, %.1f rows/s, %.2fx, %d bytes" % (name, len(rows),
+      stats['load_seconds'], stats['finish_seconds'], stats['rows_per_second'] or 0,
+      baseline / stats['seconds'] if stats['seconds'] > 0 else 0, stats['database_bytes'])
+    if options.codec is not None:
+      line += ", %s %.3fs, Data %d -> %d bytes" % (options.codec, stats['compress_seconds'],
+        stats['raw_bytes'], stats['stored_bytes'])
+    print(line)
+
+  if options.json_path:
+    with open(options.json_path, 'w') as f:
+      json.dump({
+        'benchmark': 'load',
+        'rows': len(rows),
+        'data_size': options.data_size,
+        'batch_size': options.batch_size,
+        'codec': options.codec,
+        'repeat': options.repeat,
+        'profiles': profiles,
+      }, f, indent=2)
+      f.write('\n')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import optparse
+import sqlite3
+import time
+import zlib
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program renders every note body of a NoteStore.sqlite with each of the
+# notes2html renderers, checks that they all produce the same HTML and
+# reports rendering throughput.
+#
+#   python3 -m benchmarks.render --input NoteStore.sqlite --json render.json
+#
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from notes2html import ReadAttachments, DefaultCss, RENDERERS
+
+__version__ = '1.00'
+
+def load_blobs(db):
+  "Returns (note id, decompressed ZDATA) for every note body"
+  blobs = []
+  for note_id, data in db.execute('''SELECT ZNOTE, ZDATA FROM ZICNOTEDATA WHERE ZDATA IS NOT NULL ORDER BY ZNOTE'''):
+    blobs.append((note_id, zlib.decompress(data, 15 + 32)))
+  return blobs
+
+def benchmark(path, repeat):
+  # The attachment map reads drawing and table data on first use, so the
+  # connection stays open while the renderers run
+  db = sqlite3.connect(path)
+  try:
+    return run_renderers(db, path, repeat)
+  finally:
+    db.close()
+
+def run_renderers(db, path, repeat):
+  attachments = ReadAttachments(db, path, 'bench')
+  blobs = load_blobs(db)
+  css = DefaultCss()
+
+  reference = 'etree'
+  expected = {}
+  for note_id, blob in blobs:
+    expected[note_id] = RENDERERS[reference](blob, css, attachments)
+
+  renderers = {}
+  for name in sorted(RENDERERS):
+    render = RENDERERS[name]
+    for note_id, blob in blobs:
+      if render(blob, css, attachments) != expected[note_id]:
+        raise SystemExit("ERROR: renderer '%s' differs from '%s' on note %s" % (name, reference, note_id))
+    best = None
+    for i in range(repeat):
+      started = time.perf_counter()
+      for note_id, blob in blobs:
+        render(blob, css, attachments)
+      elapsed = time.perf_counter() - started
+      if best is None or elapsed < best:
+        best = elapsed
+    renderers[name] = {
+      'seconds': best,
+      'notes_per_second': len(blobs) / best if best > 0 else None,
+    }
+
+  return {
+    'benchmark': 'render',
+    'input': path,
+    'notes': len(blobs),
+    'html_bytes': sum(len(html) for html in expected.values()),
+    'repeat': repeat,
+    'renderers': renderers,
+  }
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--input",
+                    action="store", dest="input_path", default=None,
+                    help="Path to input NoteStore.sqlite")
+  parser.add_option("", "--repeat",
+                    action="store", dest="repeat", type="int", default=3,
+                    help="Number of timed passes per renderer")
+  parser.add_option("", "--json",
+                    action="store", dest="json_path", default=None,
+                    help="Path to JSON results file")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if not options.input_path:
+    parser.error("input file not specified.")
+  inputPath = os.path.abspath(os.path.expanduser(options.input_path))
+  if not os.path.isfile(inputPath):
+    parser.error("input file '%s' does not exist." % (inputPath,))
+  if options.repeat < 1:
+    parser.error("repeat must be at least 1.")
+
+  result = benchmark(inputPath, options.repeat)
+  for name, stats in sorted(result['renderers'].items()):
+    print("render %s: %d note(s), %.3fs, %.1f notes/s" % (name, result['notes'], stats['seconds'],
+      stats['notes_per_second'] or 0))
+
+  if options.json_path:
+    with open(options.json_path, 'w') as f:
+      json.dump(result, f, indent=2)
+      f.write('\n')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import optparse
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program times readnotes.main end to end and writes the results as JSON.
+#
+# Each run executes in a fresh child process writing to an empty output
+# directory, so the peak RSS reported for a run is that of a single import.
+# Arguments after '--' are passed to readnotes.py, e.g.
+#
+#   python3 -m benchmarks.run --input NoteStore.sqlite --json result.json -- --workers 4
+#
+
+__version__ = '1.00'
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _child_main(args):
+  "Run readnotes.main in this process and print the elapsed time as JSON"
+  sys.path.insert(0, REPO_PATH)
+  import readnotes
+  sys.stdout = open(os.devnull, 'w')
+  started = time.perf_counter()
+  readnotes.main(args)
+  elapsed = time.perf_counter() - started
+  sys.stdout = sys.__stdout__
+  print(json.dumps({'seconds': elapsed}))
+
+def run_once(readnotes_args):
+  '''Runs one import in a child process; returns dict with seconds and peak_rss_kb'''
+  command = [sys.executable, '-m', 'benchmarks.run', '--child', '--'] + readnotes_args
+  child = subprocess.Popen(command, cwd=REPO_PATH, stdout=subprocess.PIPE)
+  output = child.stdout.read()
+  child.stdout.close()
+  pid, status, rusage = os.wait4(child.pid, 0)
+  child.returncode = os.waitstatus_to_exitcode(status)
+  if child.returncode != 0:
+    raise SystemExit('ERROR: readnotes exited with status %d' % (child.returncode,))
+  result = json.loads(output.decode('utf8').strip().splitlines()[-1])
+  # ru_maxrss is in kilobytes on Linux and bytes on macOS
+  peak = rusage.ru_maxrss
+  if sys.platform == 'darwin':
+    peak = peak // 1024
+  result['peak_rss_kb'] = peak
+  return result
+
+def count_output(notesdbfile):
+  '''Returns tuple (notes, rows) written to a mac_apt.db'''
+  sqlconn = sqlite3.connect(notesdbfile)
+  try:
+    rows = sqlconn.execute('SELECT count(*) FROM Notes').fetchone()[0]
+    notes = sqlconn.execute('SELECT count(*) FROM (SELECT DISTINCT Source, ID FROM Notes)').fetchone()[0]
+  finally:
+    sqlconn.close()
+  return notes, rows
+
+def benchmark(name, inputs, user, repeat, extra_args):
+  '''Times repeat imports of inputs; returns the result dict written as JSON'''
+  input_bytes = sum(os.path.getsize(path) for path in inputs)
+  runs = []
+  notes = rows = 0
+  for i in range(repeat):
+    output_path = tempfile.mkdtemp(prefix='readnotes-bench-')
+    try:
+      args = ['--user', user, '--output', output_path]
+      for path in inputs:
+        args += ['--input', path]
+      runs.append(run_once(args + extra_args))
+      notes, rows = count_output(os.path.join(output_path, 'mac_apt.db'))
+    finally:
+      shutil.rmtree(output_path, ignore_errors=True)
+
+  seconds = [run['seconds'] for run in runs]
+  best = min(seconds)
+  return {
+    'benchmark': name,
+    'schema_version': 1,
+    'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'inputs': inputs,
+    'readnotes_args': extra_args,
+    'input_bytes': input_bytes,
+    'notes': notes,
+    'rows': rows,
+    'runs': runs,
+    'best_seconds': best,
+    'median_seconds': statistics.median(seconds),
+    'notes_per_second': notes / best if best > 0 else None,
+    'mb_per_second': input_bytes / (1024 * 1024) / best if best > 0 else None,
+    'peak_rss_mb': max(run['peak_rss_kb'] for run in runs) / 1024,
+  }
+
+def print_result(result):
+  print("%s: %d note(s), %d row(s), best %.3fs, median %.3fs, %.1f notes/s, %.2f MB/s, peak RSS %.1f MB" % (
+    result['benchmark'], result['notes'], result['rows'], result['best_seconds'], result['median_seconds'],
+    result['notes_per_second'] or 0, result['mb_per_second'] or 0, result['peak_rss_mb']))
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options] [-- readnotes options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--input",
+                    action="append", dest="input_paths", default=None,
+                    help="Path to input Notes database; may be repeated")
+  parser.add_option("", "--user",
+                    action="store", dest="user_name", default="bench",
+                    help="User name passed to readnotes")
+  parser.add_option("", "--repeat",
+                    action="store", dest="repeat", type="int", default=3,
+                    help="Number of timed runs")
+  parser.add_option("", "--name",
+                    action="store", dest="name", default="readnotes",
+                    help="Benchmark name recorded in the results")
+  parser.add_option("", "--json",
+                    action="store", dest="json_path", default=None,
+                    help="Path to JSON results file")
+  parser.add_option("--child",
+                    action="store_true", dest="child", default=False,
+                    help=optparse.SUPPRESS_HELP)
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if options.child:
+    _child_main(args)
+    return
+
+  if not options.input_paths:
+    parser.error("input file not specified.")
+  if options.repeat < 1:
+    parser.error("repeat must be at least 1.")
+
+  inputs = [os.path.abspath(os.path.expanduser(path)) for path in options.input_paths]
+  for path in inputs:
+    if not os.path.isfile(path):
+      parser.error("input file '%s' does not exist." % (path,))
+
+  result = benchmark(options.name, inputs, options.user_name, options.repeat, args)
+  print_result(result)
+
+  if options.json_path:
+    with open(options.json_path, 'w') as f:
+      json.dump(result, f, indent=2)
+      f.write('\n')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,223 @@
+import os
+import sys
+import io
+import json
+import contextlib
+import optparse
+import sqlite3
+import time
+
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program checks that readnotes reads NotesVx.storedata files the same
+# way as the query it replaced, which looked up each row's folder and parent
+# account with correlated subqueries. It generates storedata fixtures, reads
+# each one with both, and compares the rows handed to the writer and the rows
+# they produce in mac_apt.db. The fixtures must contain notes in missing and
+# top level folders, notes without a body and attachments with shared or
+# missing file URLs, so each of those cases is compared.
+#
+#   python3 -m benchmarks.storedata --notes 400 --fixtures 3 --json storedata.json
+#
+
+from benchmarks import generate
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import notesdb
+import readnotes
+from readnotes import ReadAttPathFromPlist, ReadMacAbsoluteTime
+
+__version__ = '1.00'
+
+SOURCE = 'NotesV6.storedata'
+USER = 'bench'
+
+LEGACY_QUERY = "SELECT n.Z_PK as note_id, n.ZDATECREATED as created, n.ZDATEEDITED as edited, n.ZTITLE as title, "\
+               " (SELECT ZNAME from ZFOLDER where n.ZFOLDER=ZFOLDER.Z_PK) as folder, "\
+               " (SELECT zf2.ZACCOUNT from ZFOLDER as zf1  LEFT JOIN ZFOLDER as zf2 on (zf1.ZPARENT=zf2.Z_PK) where n.ZFOLDER=zf1.Z_PK) as folder_parent_id, "\
+               " ac.ZEMAILADDRESS as email, ac.ZACCOUNTDESCRIPTION as acc_desc, ac.ZUSERNAME as username, b.ZHTMLSTRING as data, "\
+               " att.ZCONTENTID as att_id, att.ZFILEURL as file_url "\
+               " FROM ZNOTE as n "\
+               " LEFT JOIN ZNOTEBODY as b ON b.ZNOTE = n.Z_PK "\
+               " LEFT JOIN ZATTACHMENT as att ON att.ZNOTE = n.Z_PK "\
+               " LEFT JOIN ZACCOUNT as ac ON ac.Z_PK = folder_parent_id"
+
+class Rows:
+  '''Writer that keeps the columns of every row it is given'''
+
+  def __init__(self):
+    self.rows = []
+
+  def add(self, columns):
+    self.rows.append(dict(columns))
+
+def read_legacy(db, source, user, writer):
+  "ReadNotesV2_V4_V6 as it was before the folder memo"
+  db.row_factory = sqlite3.Row
+  for row in db.execute(LEGACY_QUERY):
+    att_path = ''
+    if row['file_url'] != None:
+      att_path = ReadAttPathFromPlist(row['file_url'])
+
+    columns = {}
+    columns["apple_id"] = row['note_id']
+    columns["apple_title"] = row['title']
+    columns["apple_snippet"] = ''
+    columns["apple_folder"] = row['folder']
+    columns["apple_created"] = ReadMacAbsoluteTime(row['created'])
+    columns["apple_last_modified"] = ReadMacAbsoluteTime(row['edited'])
+    columns["apple_data"] = row['data']
+    columns["apple_attachment_id"] = row['att_id']
+    columns["apple_attachment_path"] = att_path
+    columns["apple_account_description"] = row['acc_desc']
+    columns["apple_account_identifier"] = row['email']
+    columns["apple_account_username"] = row['username']
+    columns["apple_version"] = 'NoteStore'
+    columns["apple_user"] = user
+    columns["apple_source"] = source
+    writer.add(columns)
+
+def read_current(db, source, user, writer):
+  # process_note prints every note title
+  with contextlib.redirect_stdout(io.StringIO()):
+    readnotes.ReadNotesV2_V4_V6(db, 'V6', source, user, writer)
+
+def ordered(rows):
+  "Rows as a sorted list; the queries have no ORDER BY"
+  return sorted(rows, key=repr)
+
+def macapt_rows(rows):
+  "Returns the rows of the Notes table of a mac_apt.db written from the given columns"
+  sqlconn = sqlite3.connect(':memory:')
+  with contextlib.redirect_stdout(io.StringIO()):
+    notesdb.create_macapt_database(sqlconn)
+  writer = notesdb.MacAptNoteBatch(sqlconn)
+  for columns in rows:
+    writer.add(columns)
+  writer.flush()
+  result = sqlconn.execute('''SELECT * FROM Notes ORDER BY Source, ID, AttachmentID;''').fetchall()
+  sqlconn.close()
+  return result
+
+def edge_cases(db, rows):
+  "Counts the rows of each case the fixture has to cover"
+  folders = set(pk for (pk,) in db.execute('''SELECT Z_PK FROM ZFOLDER;'''))
+  top_level = set(pk for (pk,) in db.execute('''SELECT Z_PK FROM ZFOLDER WHERE ZPARENT IS NULL;'''))
+  shared = set(pk for (pk,) in db.execute('''SELECT Z_PK FROM ZNOTE WHERE Z_PK IN (SELECT ZNOTE FROM ZATTACHMENT
+    WHERE ZFILEURL IN (SELECT ZFILEURL FROM ZATTACHMENT GROUP BY ZFILEURL HAVING count(*) > 1));'''))
+  note_folders = dict(db.execute('''SELECT Z_PK, ZFOLDER FROM ZNOTE;'''))
+  cases = {'missing_folder': 0, 'top_level_folder': 0, 'no_body': 0, 'null_file_url': 0, 'shared_file_url': 0}
+  for columns in rows:
+    folder = note_folders[columns["apple_id"]]
+    if folder not in folders:
+      cases['missing_folder'] += 1
+    elif folder in top_level:
+      cases['top_level_folder'] += 1
+    if columns["apple_data"] is None:
+      cases['no_body'] += 1
+    if columns["apple_attachment_id"] is not None and columns["apple_attachment_path"] == '':
+      cases['null_file_url'] += 1
+    if columns["apple_id"] in shared:
+      cases['shared_file_url'] += 1
+  return cases
+
+def timed(func, db):
+  writer = Rows()
+  started = time.perf_counter()
+  func(db, SOURCE, USER, writer)
+  return writer.rows, time.perf_counter() - started
+
+def check_fixture(notes, seed):
+  options, args = generate._get_option_parser().parse_args(['--notes', str(notes), '--seed', str(seed), '--body-size', '200'])
+  db = sqlite3.connect(':memory:')
+  generate.create_storedata(db)
+  generate.generate_storedata(db, options)
+  db.commit()
+
+  legacy, legacy_seconds = timed(read_legacy, db)
+  current, seconds = timed(read_current, db)
+  if ordered(current) != ordered(legacy):
+    raise SystemExit('ERROR: rows read from fixture %d differ from the legacy query' % (seed,))
+  rows = macapt_rows(current)
+  if rows != macapt_rows(legacy):
+    raise SystemExit('ERROR: mac_apt.db rows of fixture %d differ from the legacy query' % (seed,))
+  cases = edge_cases(db, current)
+  for case, count in cases.items():
+    if count == 0:
+      raise SystemExit("ERROR: fixture %d has no rows for case '%s'" % (seed, case))
+  db.close()
+  return {
+    'seed': seed,
+    'notes': notes,
+    'rows': len(current),
+    'macapt_rows': len(rows),
+    'cases': cases,
+    'legacy_seconds': legacy_seconds,
+    'seconds': seconds,
+  }
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--notes",
+                    action="store", dest="notes", type="int", default=400,
+                    help="Number of notes per fixture")
+  parser.add_option("", "--fixtures",
+                    action="store", dest="fixtures", type="int", default=3,
+                    help="Number of fixtures, generated with seeds 0, 1, ...")
+  parser.add_option("", "--json",
+                    action="store", dest="json_path", default=None,
+                    help="Path to JSON results file")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if options.notes < 1 or options.fixtures < 1:
+    parser.error("notes and fixtures must be at least 1.")
+
+  results = []
+  for seed in range(options.fixtures):
+    result = check_fixture(options.notes, seed)
+    results.append(result)
+    print("storedata fixture %d: %d note(s), %d row(s), %d mac_apt row(s) identical, legacy %.3fs, current %.3fs" % (
+      seed, result['notes'], result['rows'], result['macapt_rows'], result['legacy_seconds'], result['seconds']))
+    print("  " + ", ".join("%s %d" % (case, count) for case, count in result['cases'].items()))
+
+  if options.json_path:
+    with open(options.json_path, 'w') as f:
+      json.dump({'benchmark': 'storedata', 'fixtures': results}, f, indent=2)
+      f.write('\n')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import optparse
+import random
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# This program compares notes2html.svg with the per-point implementation it
+# replaced on synthetic drawings, checks that both produce the same SVG and
+# reports drawing-render throughput.
+#
+#   python3 -m benchmarks.svg --strokes 2000 --points 200 --json svg.json
+#
+
+from benchmarks.generate import make_drawing
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import notes2html
+from notes2html import E, parse, s_drawing
+
+__version__ = '1.00'
+
+def svg_legacy(drawing):
+    "notes2html.svg before the points buffer was decoded in bulk"
+    width = drawing['bounds']['width']
+    height = drawing['bounds']['height']
+    rval = E('svg',{'width':str(width),'height':str(height)})
+    inks = drawing.get('inks')
+    for stroke in drawing.get('strokes',[]):
+        if stroke.get('hidden'):
+            continue
+        if 'points' in stroke:
+            swidth=1
+            ink = inks[stroke['inkIndex']]
+            c = ink['color']
+            red = int(c['red']*255)
+            green = int(c['green']*255)
+            blue = int(c['blue']*255)
+            alpha = c['alpha']
+            if ink['identifier'] == 'com.apple.ink.marker':
+                swidth = 15
+                alpha = 0.5
+
+            color = f'rgba({red},{green},{blue},{alpha})'
+            path = ''
+            for _,x,y,*rest in struct.iter_unpack('<3f5H2B',stroke['points']):
+                path += f"L{x:.2f} {y:.2f}"
+            path = "M"+path[1:]
+
+            rval.append(E('path',{'d':"M"+path[1:],'stroke':color,'stroke-width':str(swidth),'stroke-cap':'round','fill':'none'}))
+            if 'transform' in stroke:
+                rval[-1].set('transform',"matrix({a} {b} {c} {d} {tx:.2f} {ty:.2f})".format(**stroke['transform']))
+    return rval
+
+def best_time(func, drawing, repeat):
+  best = None
+  for i in range(repeat):
+    started = time.perf_counter()
+    func(drawing)
+    elapsed = time.perf_counter() - started
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+def benchmark(strokes, points, repeat, seed):
+  rng = random.Random(seed)
+  drawing = parse(make_drawing(rng, strokes, points), s_drawing)['version'][0]['data']
+  # The empty stroke checks the "M" edge case
+  drawing['strokes'].append({'inkIndex': 0, 'points': b''})
+
+  if ET.tostring(svg_legacy(drawing)) != ET.tostring(notes2html.svg(drawing)):
+    raise SystemExit('ERROR: SVG output differs from the legacy implementation')
+
+  legacy = best_time(svg_legacy, drawing, repeat)
+  current = best_time(notes2html.svg, drawing, repeat)
+  total_points = strokes * points
+  return {
+    'benchmark': 'svg',
+    'strokes': strokes,
+    'points_per_stroke': points,
+    'repeat': repeat,
+    'legacy_seconds': legacy,
+    'seconds': current,
+    'legacy_points_per_second': total_points / legacy if legacy > 0 else None,
+    'points_per_second': total_points / current if current > 0 else None,
+    'speedup': legacy / current if current > 0 else None,
+  }
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--strokes",
+                    action="store", dest="strokes", type="int", default=1000,
+                    help="Strokes in the drawing")
+  parser.add_option("", "--points",
+                    action="store", dest="points", type="int", default=200,
+                    help="Points per stroke")
+  parser.add_option("", "--repeat",
+                    action="store", dest="repeat", type="int", default=5,
+                    help="Number of timed renders of each implementation")
+  parser.add_option("", "--seed",
+                    action="store", dest="seed", type="int", default=0,
+                    help="Random seed")
+  parser.add_option("", "--json",
+                    action="store", dest="json_path", default=None,
+                    help="Path to JSON results file")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if options.strokes < 1 or options.points < 1:
+    parser.error("strokes and points must be at least 1.")
+  if options.repeat < 1:
+    parser.error("repeat must be at least 1.")
+
+  result = benchmark(options.strokes, options.points, options.repeat, options.seed)
+  print("svg: %d stroke(s) x %d point(s), legacy %.3fs, current %.3fs, %.0f points/s, %.1fx" % (
+    result['strokes'], result['points_per_stroke'], result['legacy_seconds'], result['seconds'],
+    result['points_per_second'] or 0, result['speedup'] or 0))
+
+  if options.json_path:
+    with open(options.json_path, 'w') as f:
+      json.dump(result, f, indent=2)
+      f.write('\n')
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,259 @@
+import os
+import sys
+import mmap
+import optparse
+import queue
+import threading
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Packed store for the decompressed note blobs written by readnotes --blob.
+#
+# blobs.pack holds the blobs back to back and is only ever appended to.
+# blobs.idx has one line per blob, "offset<TAB>length<TAB>note id<TAB>source",
+# written after the blob itself; when a note is written again (e.g. by an
+# incremental run) the last line for it wins.
+#
+# Superseded blobs stay in the pack until it is compacted: compact() rewrites
+# it with only the blob written last for each note, leaving out the blobs of
+# sources that were read again in full and of notes deleted from their source.
+# readnotes compacts the pack after every run.
+#
+# This program prints a blob by note id:
+#
+#   python3 blobpack.py --blob ~/notes_macos/blob --id 42 > note42.pb
+#
+
+__version__ = '1.00'
+
+PACK_NAME = 'blobs.pack'
+INDEX_NAME = 'blobs.idx'
+
+class BlobPackWriter:
+  '''Appends blobs to a pack on a background thread.
+
+  write() may be called from several reader threads; it blocks once
+  queue_size blobs are waiting so memory use stays bounded.
+  '''
+
+  def __init__(self, path, queue_size=64):
+    self.path = path
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.error = None
+    self.count = 0
+    self.data = open(os.path.join(path, PACK_NAME), 'ab')
+    # Blobs before this offset were written by earlier runs
+    self.start = os.fstat(self.data.fileno()).st_size
+    self.index = open(os.path.join(path, INDEX_NAME), 'a', encoding='utf8')
+    self.thread = threading.Thread(target=self._run, name='blobpack', daemon=True)
+    self.thread.start()
+
+  def write(self, source, note_id, data):
+    '''Queues a blob; data is bytes, None, or an iterable of byte chunks'''
+    if self.error is not None:
+      raise RuntimeError('blob writer failed: %s' % (self.error,))
+    self.queue.put((source, note_id, data))
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      if self.error is not None:
+        # Keep draining so readers blocked in write() can finish
+        continue
+      try:
+        self._append(*item)
+      except Exception as ex:
+        self.error = ex
+
+  def _append(self, source, note_id, data):
+    offset = self.data.tell()
+    if data is None:
+      pass
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+      self.data.write(data)
+    else:
+      for chunk in data:
+        self.data.write(chunk)
+    length = self.data.tell() - offset
+    self.index.write('%d\t%d\t%s\t%s\n' % (offset, length, note_id, source))
+    self.count += 1
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.data.close()
+    self.index.close()
+    if self.error is not None:
+      raise RuntimeError('blob writer failed: %s' % (self.error,))
+
+class BlobPack:
+  '''Read-only view of a pack; blobs are sliced out of a memory map'''
+
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    self.latest = {}
+    self.file = open(os.path.join(path, PACK_NAME), 'rb')
+    size = os.fstat(self.file.fileno()).st_size
+    with open(os.path.join(path, INDEX_NAME), 'r', encoding='utf8') as f:
+      for line in f:
+        if not line.endswith('\n'):
+          # Partial line from an interrupted run
+          break
+        offset, length, note_id, source = line[:-1].split('\t', 3)
+        entry = (int(offset), int(length))
+        if entry[0] + entry[1] > size:
+          # Indexed before its data reached the pack file
+          continue
+        self.entries[(source, note_id)] = entry
+        self.latest[note_id] = entry
+    self.map = None
+    if size > 0:
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def _entry(self, note_id, source=None):
+    if source is None:
+      return self.latest[str(note_id)]
+    return self.entries[(source, str(note_id))]
+
+  def view(self, note_id, source=None):
+    '''Returns a memoryview of the blob without copying it; raises KeyError if unknown.
+
+    Without source the blob written last for note_id is returned. Views must
+    be released before the pack is closed.
+    '''
+    offset, length = self._entry(note_id, source)
+    if length == 0:
+      return memoryview(b'')
+    return memoryview(self.map)[offset:offset + length]
+
+  def get(self, note_id, source=None):
+    '''Returns the blob as bytes; raises KeyError if unknown'''
+    offset, length = self._entry(note_id, source)
+    if length == 0:
+      return b''
+    return self.map[offset:offset + length]
+
+  def __contains__(self, note_id):
+    return str(note_id) in self.latest
+
+  def __len__(self):
+    return len(self.entries)
+
+  def keys(self):
+    '''Returns the (source, note id) pairs in the pack'''
+    return self.entries.keys()
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def compact(path, replaced=(), before=0, deleted=()):
+  '''Rewrites the pack with only the blob written last for each note.
+
+  Blobs of the sources in replaced written before offset before, and the
+  blobs of the (source, note id) pairs in deleted, are left out as well.
+  Returns tuple (size before, size after) of the pack.
+  '''
+  replaced = set(replaced)
+  deleted = set((source, str(note_id)) for source, note_id in deleted)
+  with BlobPack(path) as pack:
+    size = os.fstat(pack.file.fileno()).st_size
+    keep = []
+    for (source, note_id), (offset, length) in pack.entries.items():
+      if source in replaced and offset < before:
+        continue
+      if (source, note_id) in deleted:
+        continue
+      keep.append((offset, length, note_id, source))
+    keep.sort()
+    if len(keep) == len(pack.entries) and sum(entry[1] for entry in keep) == size:
+      return size, size
+    data_path = os.path.join(path, PACK_NAME + '.tmp')
+    index_path = os.path.join(path, INDEX_NAME + '.tmp')
+    with open(data_path, 'wb') as data, open(index_path, 'w', encoding='utf8') as index:
+      for offset, length, note_id, source in keep:
+        if length > 0:
+          data.write(pack.map[offset:offset + length])
+        index.write('%d\t%d\t%s\t%s\n' % (data.tell() - length, length, note_id, source))
+      compacted = data.tell()
+  os.replace(data_path, os.path.join(path, PACK_NAME))
+  os.replace(index_path, os.path.join(path, INDEX_NAME))
+  return size, compacted
+
+def _get_option_parser():
+  parser = optparse.OptionParser('%prog [options]',
+                                 version='%prog ' + __version__)
+  parser.add_option("", "--blob",
+                    action="store", dest="blob_path", default=None,
+                    help="Path to 'blob' directory written by readnotes --blob")
+  parser.add_option("", "--id",
+                    action="store", dest="note_id", default=None,
+                    help="Note id of the blob to print")
+  parser.add_option("", "--source",
+                    action="store", dest="source", default=None,
+                    help="Input database the note was read from, if several were")
+  parser.add_option("", "--compact",
+                    action="store_true", dest="compact", default=False,
+                    help="Rewrite the pack with only the latest blob of each note")
+  return parser
+
+def main(args):
+  parser = _get_option_parser()
+  (options, args) = parser.parse_args(args)
+
+  if not options.blob_path:
+    parser.error("BLOB path not specified.")
+  if options.compact:
+    size, compacted = compact(os.path.expanduser(options.blob_path))
+    print("blob pack: %d bytes compacted to %d bytes" % (size, compacted))
+    return
+  if not options.note_id:
+    parser.error("note id not specified.")
+
+  with BlobPack(os.path.expanduser(options.blob_path)) as pack:
+    try:
+      data = pack.view(options.note_id, options.source)
+    except KeyError:
+      parser.error("note '%s' is not in the pack." % (options.note_id,))
+    sys.stdout.buffer.write(data)
+    data.release()
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
@@ -0,0 +1,216 @@
+import os
+import json
+import threading
+import time
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Index of the attachment files under a Notes group container, used by
+# notes2html instead of a stat call per attachment.
+#
+# The Media/ and FallbackImages/ trees are listed once with os.scandir. The
+# listing can be saved to a JSON file together with the modification time of
+# every directory it read; a later run reuses it if none of those directories
+# has changed, since adding, removing or renaming an entry updates the
+# modification time of the directory holding it.
+#
+# LazyMediaIndex defers all of that to the first lookup, so runs that render
+# no attachment (storedata files, incremental runs with nothing changed) never
+# touch the media root.
+#
+
+__version__ = '1.00'
+
+INDEX_VERSION = 1
+
+MEDIA_DIRS = ('Media', 'FallbackImages')
+
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+class MediaIndex:
+  '''Set of the files under the Media/ and FallbackImages/ directories of root.
+
+  Paths are kept relative to root with '/' separators. Instances only hold
+  plain data so they can be pickled to decode workers.
+  '''
+
+  def __init__(self, root, paths=None, mtimes=None):
+    self.root = root
+    self.paths = set(paths or ())
+    self.mtimes = dict(mtimes or {})
+    self.scanned = False
+
+  @classmethod
+  def scan(cls, root):
+    index = cls(root)
+    for name in MEDIA_DIRS:
+      index._scan_dir(name)
+    index.scanned = True
+    return index
+
+  def _scan_dir(self, relative):
+    path = os.path.join(self.root, relative)
+    self.mtimes[relative] = _mtime(path)
+    if self.mtimes[relative] is None:
+      return
+    try:
+      entries = list(os.scandir(path))
+    except OSError:
+      return
+    for entry in entries:
+      name = relative + '/' + entry.name
+      try:
+        if entry.is_dir():
+          self._scan_dir(name)
+        else:
+          self.paths.add(name)
+      except OSError:
+        pass
+
+  @classmethod
+  def load(cls, root, path=None):
+    '''Returns the index saved at path if it is still current, otherwise scans root and saves it'''
+    if path is not None:
+      index = cls.read(root, path)
+      if index is not None:
+        return index
+    index = cls.scan(root)
+    if path is not None:
+      index.write(path)
+    return index
+
+  @classmethod
+  def read(cls, root, path):
+    '''Returns the index saved at path, or None if it is missing, for another root or stale'''
+    try:
+      with open(path, 'r', encoding='utf8') as f:
+        saved = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(saved, dict) or saved.get('version') != INDEX_VERSION or saved.get('root') != root:
+      return None
+    mtimes = saved.get('mtimes', {})
+    for name in MEDIA_DIRS:
+      if name not in mtimes:
+        return None
+    for relative, mtime in mtimes.items():
+      if _mtime(os.path.join(root, relative)) != mtime:
+        return None
+    return cls(root, saved.get('paths', ()), mtimes)
+
+  def write(self, path):
+    saved = {
+      'version': INDEX_VERSION,
+      'root': self.root,
+      'mtimes': self.mtimes,
+      'paths': sorted(self.paths),
+    }
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf8') as f:
+      json.dump(saved, f)
+    os.replace(temp, path)
+
+  def relative(self, path):
+    '''Returns path relative to root with '/' separators, or None if it is outside root'''
+    if os.path.isabs(path):
+      path = os.path.relpath(path, self.root)
+      if path == os.pardir or path.startswith(os.pardir + os.sep):
+        return None
+    return path.replace(os.sep, '/')
+
+  def exists(self, path):
+    '''Answers os.path.exists for a file under root, absolute or relative to root'''
+    relative = self.relative(path)
+    return relative is not None and relative in self.paths
+
+  def fallback_image(self, id):
+    '''Returns the path of the fallback image of an attachment, or None if there is none'''
+    relative = 'FallbackImages/' + id + '.jpg'
+    if relative in self.paths:
+      return os.path.join(self.root, 'FallbackImages', id + '.jpg')
+    return None
+
+  def __contains__(self, path):
+    return self.exists(path)
+
+  def __len__(self):
+    return len(self.paths)
+
+class LazyMediaIndex:
+  '''MediaIndex of root that is only loaded (or scanned) when first looked up.
+
+  Safe to share between reader threads. Pickling it, e.g. to decode workers,
+  loads it first, so workers never scan root themselves. timer, if given,
+  receives the load time as stage 'media_index'.
+  '''
+
+  def __init__(self, root, path=None, timer=None):
+    self.root = root
+    self.path = path
+    self.timer = timer
+    self.index = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    with self.lock:
+      if self.index is None:
+        started = time.perf_counter()
+        self.index = MediaIndex.load(self.root, self.path)
+        if self.timer is not None:
+          self.timer.add('media_index', time.perf_counter() - started)
+        if self.index.scanned and self.path is not None:
+          print("media index: %d files under '%s' written to '%s'" % (len(self.index), self.root, self.path))
+    return self.index
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['index'] = self.load()
+    state['timer'] = None
+    del state['lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
+  def exists(self, path):
+    return self.load().exists(path)
+
+  def fallback_image(self, id):
+    return self.load().fallback_image(id)
+
+  def __contains__(self, path):
+    return self.exists(path)
+
+  def __len__(self):
+    return len(self.load())
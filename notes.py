@@ -23,6 +23,7 @@ import binascii
 import sqlite3
 import zlib
 import struct
+import notesinput
 
 __Plugin_Name = "NOTES"
 __Plugin_Friendly_Name = "Notes"
@@ -312,7 +313,7 @@ def ReadQueryResults(cursor, notes, user, source):
 def OpenDb(inputPath):
     log.info ("Processing file " + inputPath)
     try:
-        conn = sqlite3.connect(inputPath)
+        conn = notesinput.connect(inputPath)
         log.debug ("Opened database successfully")
         return conn
     except sqlite3.Error:
@@ -325,6 +326,8 @@ def OpenDbFromImage(mac_info, inputPath, user):
     try:
         sqlite = SqliteWrapper(mac_info)
         conn = sqlite.connect(inputPath)
+        # The wrapper reads a copy exported from the image; only tune it for scanning
+        notesinput.tune(conn)
         log.debug ("Opened database successfully")
         return conn, sqlite
     except sqlite3.Error:
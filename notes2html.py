@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 import os, sqlite3, json, struct, re, zipfile, sys
+import array
+import collections
+import copy
+import hashlib
+import time
 import zlib
 import xml.etree.ElementTree as ET
 import urllib
+import notesinput
 
 # https://github.com/dunhamsteve/notesutils
 #
@@ -33,11 +39,47 @@ import urllib
 
 # https://github.com/dunhamsteve/notesutils/blob/master/notes.md
 
-def GetUncompressedData(compressed):
+# Bump when a change to the renderer changes its HTML output; it is part of
+# the render cache key.
+RENDERER_VERSION = '1'
+
+# Size of the pieces a ZDATA blob is inflated in when a ceiling is set
+INFLATE_CHUNK_SIZE = 1024 * 1024
+
+class NoteTooLarge(Exception):
+  '''Raised when a note or attachment blob inflates to more than its ceiling'''
+  pass
+
+def InflateChunks(compressed, chunk_size=INFLATE_CHUNK_SIZE):
+  '''Yields the decompressed blob in pieces of at most chunk_size bytes'''
+  d = zlib.decompressobj(15 + 32)
+  chunk = d.decompress(compressed, chunk_size)
+  while chunk:
+    yield chunk
+    chunk = d.decompress(d.unconsumed_tail, chunk_size)
+  if not d.eof:
+    raise zlib.error('incomplete or truncated stream')
+
+def InflateBounded(compressed, max_size):
+  '''Returns the decompressed blob; raises NoteTooLarge once it passes max_size bytes'''
+  chunks = []
+  total = 0
+  for chunk in InflateChunks(compressed):
+    total += len(chunk)
+    if total > max_size:
+      raise NoteTooLarge(total)
+    chunks.append(chunk)
+  return b''.join(chunks)
+
+def GetUncompressedData(compressed, max_size=None):
+  "Inflates a blob; with max_size set raises NoteTooLarge once it passes max_size bytes"
   if compressed == None:
     return None
   data = None
-  data = zlib.decompress(compressed, 15 + 32)
+  if max_size is None:
+    data = zlib.decompress(compressed, 15 + 32)
+  else:
+    data = InflateBounded(compressed, max_size)
   return data
 
 # HTML construction utils
@@ -89,31 +131,324 @@ def readstruct(fmt,l):
 
 readers = [ uvarint, readstruct('<d',8), readbytes, None, None, readstruct('<f',4) ]
 
+def skipvarint(data,pos):
+    while data[pos] >= 0x80:
+        pos += 1
+    return pos+1
+
+def skipbytes(data,pos):
+    l,pos = uvarint(data,pos)
+    return pos+l
+
+skippers = [ skipvarint, lambda data,pos: pos+8, skipbytes, None, None, lambda data,pos: pos+4 ]
+
 def parse(data, schema):
+    "parses a protobuf"
     if data is None:
       data = b''
-    "parses a protobuf"
+    view = memoryview(data)
+    return decoder(schema)(view, 0, len(view))
+
+def parseview(data, pos, end, schema):
+    """parses the protobuf message in data[pos:end] without copying nested messages
+
+    Unknown fields are skipped without being read, and repeated fields are
+    appended in place.
+    """
     obj = {}
-    pos = 0
-    while pos < len(data):
+    while pos < end:
         val,pos = uvarint(data,pos)
-        typ = val & 7
-        key = val >> 3
-        val, pos = readers[typ](data,pos)
-        if key not in schema: 
+        wire = val & 7
+        field = schema.get(val >> 3)
+        if field is None:
+            pos = skippers[wire](data,pos)
             continue
-        name, repeated, typ = schema[key]
+        name, repeated, typ = field
+        if wire == 2:
+            l,start = uvarint(data,pos)
+            pos = start+l
+            if isinstance(typ, dict):
+                val = parseview(data, start, min(pos, end), typ)
+            elif typ == 'string':
+                val = str(data[start:pos],'utf8')
+            else:
+                val = data[start:pos].tobytes()
+        else:
+            val,pos = readers[wire](data,pos)
+            if typ == 'string':
+                val = val.decode('utf8')
+        if repeated:
+            values = obj.get(name)
+            if values is None:
+                obj[name] = [val]
+            else:
+                values.append(val)
+        else:
+            obj[name] = val
+    return obj
+
+# Schema compiler: turns a schema into generated decoder functions that do
+# the same as parseview, with each known field's tag tested inline instead
+# of looked up and interpreted per field. Schemas are treated as constants;
+# each is compiled once, on first use or at import for the ones below.
+
+_decoders = {}
+
+def _parse_field(obj, data, pos, end, key, schema):
+    "one field as parseview reads it; used for unknown fields and unexpected wire types"
+    wire = key & 7
+    field = schema.get(key >> 3)
+    if field is None:
+        return skippers[wire](data,pos)
+    name, repeated, typ = field
+    if wire == 2:
+        l,start = uvarint(data,pos)
+        pos = start+l
         if isinstance(typ, dict):
-            val = parse(val, typ)
+            val = decoder(typ)(data, start, min(pos, end))
+        elif typ == 'string':
+            val = str(data[start:pos],'utf8')
+        else:
+            val = data[start:pos].tobytes()
+    else:
+        val,pos = readers[wire](data,pos)
         if typ == 'string':
             val = val.decode('utf8')
-        if repeated:
-            val = obj.get(name,[]) + [val]
+    if repeated:
+        values = obj.get(name)
+        if values is None:
+            obj[name] = [val]
+        else:
+            values.append(val)
+    else:
         obj[name] = val
-    return obj
+    return pos
+
+def _field_source(name, repeated, typ, wire, names):
+    "Returns the lines decoding one field with the given wire type, or None to leave it to _parse_field"
+    lines = []
+    if wire == 2:
+        lines += [
+            "l,start = uvarint(data,pos)",
+            "pos = start+l",
+        ]
+        if isinstance(typ, dict):
+            lines.append("val = %s(data, start, pos if pos < end else end)" % (names[id(typ)],))
+        elif typ == 'string':
+            lines.append("val = str(data[start:pos],'utf8')")
+        else:
+            lines.append("val = data[start:pos].tobytes()")
+    elif typ == 'string' or isinstance(typ, dict):
+        return None
+    elif wire == 0:
+        lines += [
+            "val = data[pos]",
+            "if val < 0x80:",
+            "    pos += 1",
+            "else:",
+            "    val,pos = uvarint(data,pos)",
+        ]
+    elif wire == 1:
+        lines += [
+            "val = unpack_double(data,pos)[0]",
+            "pos += 8",
+        ]
+    elif wire == 5:
+        lines += [
+            "val = unpack_float(data,pos)[0]",
+            "pos += 4",
+        ]
+    if repeated:
+        lines += [
+            "values = obj.get(%r)" % (name,),
+            "if values is None:",
+            "    obj[%r] = [val]" % (name,),
+            "else:",
+            "    values.append(val)",
+        ]
+    else:
+        lines.append("obj[%r] = val" % (name,))
+    return lines
+
+def compile_schema(schema):
+    "Returns a function decode(data, pos, end) giving the same dict as parseview(data, pos, end, schema)"
+    # Collect every message schema reachable from this one; shared ones are compiled once
+    names = {}
+    order = []
+    pending = [schema]
+    while pending:
+        message = pending.pop()
+        if id(message) in names:
+            continue
+        names[id(message)] = '_decode_%d' % (len(order),)
+        order.append(message)
+        for name, repeated, typ in message.values():
+            if isinstance(typ, dict):
+                pending.append(typ)
+
+    namespace = {
+        'uvarint': uvarint,
+        'unpack_double': struct.Struct('<d').unpack_from,
+        'unpack_float': struct.Struct('<f').unpack_from,
+        '_parse_field': _parse_field,
+    }
+    source = []
+    for message in order:
+        schema_name = names[id(message)] + '_schema'
+        namespace[schema_name] = message
+        source += [
+            "def %s(data, pos, end):" % (names[id(message)],),
+            "    obj = {}",
+            "    while pos < end:",
+            "        key = data[pos]",
+            "        if key < 0x80:",
+            "            pos += 1",
+            "        else:",
+            "            key,pos = uvarint(data,pos)",
+        ]
+        branch = 'if'
+        for number, (name, repeated, typ) in sorted(message.items()):
+            if isinstance(typ, dict) or typ in ('string', 'bytes'):
+                wires = (2,)
+            else:
+                wires = (0, 5, 1, 2)
+            for wire in wires:
+                lines = _field_source(name, repeated, typ, wire, names)
+                if lines is None:
+                    continue
+                source.append("        %s key == %d:" % (branch, (number << 3) | wire))
+                source += ["            " + line for line in lines]
+                branch = 'elif'
+        if branch == 'if':
+            source.append("        pos = _parse_field(obj, data, pos, end, key, %s)" % (schema_name,))
+        else:
+            source += [
+                "        else:",
+                "            pos = _parse_field(obj, data, pos, end, key, %s)" % (schema_name,),
+            ]
+        source += ["    return obj", ""]
+
+    exec(compile("\n".join(source), '<schema %s>' % (names[id(schema)],), 'exec'), namespace)
+    for message in order:
+        entry = _decoders.get(id(message))
+        # An entry for another object is left over from a collected schema that had the same id
+        if entry is None or entry[0] is not message:
+            _decoders[id(message)] = (message, namespace[names[id(message)]])
+    return namespace[names[id(schema)]]
+
+def decoder(schema):
+    "Returns the compiled decoder of schema, compiling it the first time"
+    entry = _decoders.get(id(schema))
+    if entry is None or entry[0] is not schema:
+        return compile_schema(schema)
+    return entry[1]
+
+# A drawing point is a <3f5H2B record, 24 bytes or six 4-byte words;
+# x and y are the second and third words.
+POINT_RECORD = struct.Struct('<3f5H2B')
+
+class DrawingOptions:
+    """How drawing strokes are written as SVG paths.
+
+    tolerance > 0 drops points closer than tolerance to the simplified stroke
+    (Douglas-Peucker); precision is the number of decimals per coordinate.
+    original_bytes (estimated) and rendered_bytes total the path data without
+    and with these options; readnotes adds them up in the main process. Notes
+    served from the render cache are not rendered, so they are not counted.
+    """
+
+    def __init__(self, tolerance=0.0, precision=2):
+        self.tolerance = tolerance
+        self.precision = precision
+        self.original_bytes = 0
+        self.rendered_bytes = 0
+
+    def is_default(self):
+        return self.tolerance <= 0 and self.precision == 2
+
+    def key(self):
+        "Returns a string identifying the options, for cache keys"
+        return '%r:%d' % (float(self.tolerance), self.precision)
+
+def simplify_stroke(xs, ys, tolerance):
+    "Douglas-Peucker; returns the indexes of the points kept, first and last included"
+    n = len(xs)
+    if n < 3:
+        return list(range(n))
+    keep = bytearray(n)
+    keep[0] = keep[n-1] = 1
+    limit = tolerance * tolerance
+    stack = [(0, n-1)]
+    while stack:
+        first, last = stack.pop()
+        x0 = xs[first]
+        y0 = ys[first]
+        dx = xs[last] - x0
+        dy = ys[last] - y0
+        norm = dx*dx + dy*dy
+        worst = -1.0
+        index = first
+        for i in range(first+1, last):
+            px = xs[i] - x0
+            py = ys[i] - y0
+            if norm == 0:
+                d = px*px + py*py
+            else:
+                cross = px*dy - py*dx
+                d = cross*cross / norm
+            if d > worst:
+                worst = d
+                index = i
+        if worst > limit:
+            keep[index] = 1
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i in range(n) if keep[i]]
 
-def svg(drawing):
-    "Convert note drawing to SVG"
+def stroke_path(points, tolerance=0.0, precision=2):
+    "Returns the SVG path data for a stroke's points buffer"
+    if len(points) % POINT_RECORD.size:
+        raise struct.error('points buffer is not a multiple of %d bytes' % (POINT_RECORD.size,))
+    words = array.array('f')
+    words.frombytes(points)
+    if sys.byteorder != 'little':
+        words.byteswap()
+    xs = words[1::6]
+    ys = words[2::6]
+    if tolerance > 0:
+        kept = simplify_stroke(xs, ys, tolerance)
+        xs = [xs[i] for i in kept]
+        ys = [ys[i] for i in kept]
+    count = len(xs)
+    if count == 0:
+        return "M"
+    # Interleave x and y and format the whole path with one % operation
+    xy = [0.0] * (2 * count)
+    xy[0::2] = xs
+    xy[1::2] = ys
+    point = "%.{0}f %.{0}f".format(precision)
+    return ("M" + point + ("L" + point) * (count - 1)) % tuple(xy)
+
+def unsimplified_size(points, path, precision):
+    """Estimates the size of stroke_path(points) from the path written with other options.
+
+    Each point takes "L" plus two coordinates; the mean width of the kept
+    points is adjusted for the decimals dropped and applied to all of them,
+    so the full precision path is never formatted."""
+    count = len(points) // POINT_RECORD.size
+    if count == 0:
+        return 1
+    decimals = lambda digits: digits + 1 if digits > 0 else 0
+    kept = path.count('L') + 1
+    per_point = len(path) / kept + 2 * (decimals(2) - decimals(precision))
+    return int(round(per_point * count))
+
+def svg(drawing, options=None, stats=None):
+    """Convert note drawing to SVG.
+
+    With non-default DrawingOptions, stats (a two item list) receives the
+    path data bytes before they were applied, as estimated by
+    unsimplified_size, and after."""
     width = drawing['bounds']['width']
     height = drawing['bounds']['height']
     rval = E('svg',{'width':str(width),'height':str(height)})
@@ -134,12 +469,15 @@ def svg(drawing):
                 alpha = 0.5
 
             color = f'rgba({red},{green},{blue},{alpha})'
-            path = ''
-            for _,x,y,*rest in struct.iter_unpack('<3f5H2B',stroke['points']):
-                path += f"L{x:.2f} {y:.2f}"
-            path = "M"+path[1:]
-            
-            rval.append(E('path',{'d':"M"+path[1:],'stroke':color,'stroke-width':str(swidth),'stroke-cap':'round','fill':'none'}))
+            if options is None or options.is_default():
+                path = stroke_path(stroke['points'])
+            else:
+                path = stroke_path(stroke['points'], options.tolerance, options.precision)
+                if stats is not None:
+                    stats[0] += unsimplified_size(stroke['points'], path, options.precision)
+                    stats[1] += len(path)
+
+            rval.append(E('path',{'d':path,'stroke':color,'stroke-width':str(swidth),'stroke-cap':'round','fill':'none'}))
             if 'transform' in stroke:
                 rval[-1].set('transform',"matrix({a} {b} {c} {d} {tx:.2f} {ty:.2f})".format(**stroke['transform']))
     return rval
@@ -163,7 +501,9 @@ def render_html(note,attachments):
           tag = ['ul','ul','ol','ul'][pstyle - 100]
           par = rval
           while indent > 0:
-            last = par.getchildren()[-1]
+            if len(par) == 0:
+              break
+            last = par[-1]
             if last.tag != tag:
               break
             par = last
@@ -172,15 +512,15 @@ def render_html(note,attachments):
             par = append(par,E(tag))
             indent -= 1
           par = append(par,E('li'))
-        elif pstyle == 4 and rval.getchildren()[-1].tag == 'pre':
-          par = rval.getchildren()[-1]
+        elif pstyle == 4 and len(rval) > 0 and rval[-1].tag == 'pre':
+          par = rval[-1]
           append(par,"\n")
         else:
           par = append(rval,E(styles.get(pstyle,'p')))
         if pstyle == 103:
           par.append(E('input',{"type":"checkbox"}))
           if run.get('todo',{}).get('done'):
-            par[0].put('checked','')
+            par[0].set('checked','')
       if frag == '\n':
         par = None
       else:
@@ -197,7 +537,8 @@ def render_html(note,attachments):
           #print("ATTACHMENT: '%s'" % (info.get('attachmentIdentifier')))
           attach = attachments.get(info.get('attachmentIdentifier'))
           if attach is not None and attach.get('html') is not None:
-            frag = attach.get('html')
+            # copy so text following the attachment does not leak into the shared fragment's tail
+            frag = copy.copy(attach.get('html'))
             #print("HTML: %s" % (ET.tostring(frag,method='html')))
           else:
             root  = '/Users/' + 'none' + '/Library/Group Containers/group.com.apple.notes'
@@ -209,6 +550,112 @@ def render_html(note,attachments):
     pos += l
   return rval
 
+# Streaming renderer: writes the same HTML as render_html and ET.tostring
+# without building a tree. Paragraph elements stay open on a stack, since
+# later paragraphs may still go into the last list or pre block.
+
+def escape_text(text):
+  "Escape character data like ElementTree's HTML serializer"
+  if "&" in text:
+    text = text.replace("&", "&amp;")
+  if "<" in text:
+    text = text.replace("<", "&lt;")
+  if ">" in text:
+    text = text.replace(">", "&gt;")
+  return text
+
+def escape_attribute(text):
+  "Escape an attribute value like ElementTree's HTML serializer"
+  if "&" in text:
+    text = text.replace("&", "&amp;")
+  if ">" in text:
+    text = text.replace(">", "&gt;")
+  if "\"" in text:
+    text = text.replace("\"", "&quot;")
+  return text
+
+def attachment_markup(attach):
+  "Returns the serialized HTML of a rendered attachment, memoized on it"
+  markup = attach.get('markup')
+  if markup is None:
+    markup = attach['markup'] = ET.tostring(attach['html'], encoding='unicode', method='html')
+  return markup
+
+def render_html_stream(note, attachments, write, tag='div'):
+  "Write the HTML of note attributed string to write(str); same output as render_html"
+  styles = {0:'h1',1:'h2',4:'pre',100:'li',101:'li',102:'li',103:'li'}
+  stack = [tag]
+  write('<' + tag + '>')
+
+  def close(depth):
+    while len(stack) > depth + 1:
+      write('</' + stack.pop() + '>')
+
+  def open_element(name):
+    write('<' + name + '>')
+    stack.append(name)
+
+  txt = note['string']
+  pos = 0
+  in_paragraph = False
+  for run in note.get('attributeRun',[]):
+    l = run['length']
+    for frag in re.findall(r'\n|[^\n]+',txt[pos:pos+l]):
+      if not in_paragraph: # start paragraph
+        pstyle = run.get('paragraphStyle',{}).get('style',-1)
+        indent = run.get('paragraphStyle',{}).get('indent',0)
+        if pstyle > 100:
+          # stack[1:] is the chain of last children render_html walks when merging lists
+          list_tag = ['ul','ul','ol','ul'][pstyle - 100]
+          depth = 0
+          while indent > 0 and depth + 1 < len(stack) and stack[depth + 1] == list_tag:
+            depth += 1
+            indent -= 1
+          close(depth)
+          while indent >= 0:
+            open_element(list_tag)
+            indent -= 1
+          open_element('li')
+        elif pstyle == 4 and len(stack) > 1 and stack[1] == 'pre':
+          close(1)
+          write("\n")
+        else:
+          close(0)
+          open_element(styles.get(pstyle,'p'))
+        if pstyle == 103:
+          if run.get('todo',{}).get('done'):
+            write('<input type="checkbox" checked="">')
+          else:
+            write('<input type="checkbox">')
+        in_paragraph = True
+      if frag == '\n':
+        in_paragraph = False
+        continue
+      info = run.get('attachmentInfo')
+      if info:
+        attach = attachments.get(info.get('attachmentIdentifier'))
+        if attach is not None and attach.get('html') is not None:
+          write(attachment_markup(attach))
+        else:
+          root  = '/Users/' + 'none' + '/Library/Group Containers/group.com.apple.notes'
+          fn = os.path.join(root,'Media',info.get('attachmentIdentifier'),'missing.txt')
+          att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
+          write('<a href="' + escape_attribute(att_url) + '">' + escape_text(att_url) + '</a>')
+        continue
+      link = run.get('link')
+      if link:
+        frag = '<a href="' + escape_attribute(link) + '">' + escape_text(link) + '</a>'
+      else:
+        frag = escape_text(frag)
+      style = run.get('fontHints',0) + 4*run.get('underline',0) + 8*run.get('strikethrough',0)
+      if style & 1: frag = '<b>' + frag + '</b>'
+      if style & 2: frag = '<em>' + frag + '</em>'
+      if style & 4: frag = '<u>' + frag + '</u>'
+      if style & 8: frag = '<strike>' + frag + '</strike>'
+      write(frag)
+    pos += l
+  close(-1)
+
 def process_archive(table):
   "Decode a 'CRArchive'"
   objects = []
@@ -344,6 +791,9 @@ s_table = { 2: ["version", 1, { 3: ["data", 0, {
     6:["uuidItem",1,"bytes"]
 }]}]}
 
+for _schema in (s_doc, s_drawing, s_table):
+    decoder(_schema)
+
 def write(data,*path):
     path = os.path.join(*path)
     os.makedirs(os.path.dirname(path),exist_ok=True)
@@ -359,47 +809,201 @@ def DefaultCss():
 '''
   return css
 
-# attachments = {}
-def ReadAttachments(db, attachments, source, user):
-  root  = '/Users/' + user + '/Library/Group Containers/group.com.apple.notes'
-  mquery = '''select a.zidentifier, a.zmergeabledata, a.ztypeuti, b.zidentifier, b.zfilename, a.zurlstring,a.ztitle
-    from ziccloudsyncingobject a left join ziccloudsyncingobject b on a.zmedia = b.z_pk
-    where a.zcryptotag is null and a.ztypeuti is not null'''
-  for id, data, typ, id2, fname, url,title in db.execute(mquery):
-    if url is None:
-      url = ''
-    if title is None:
-      title = ''
-    if typ == 'com.apple.drawing' and data:
-      doc = parse(GetUncompressedData(data),s_drawing)
-      attachments[id] = {'html': svg(doc['version'][0]['data'])}
-    elif typ == 'com.apple.notes.table' and data:
-      doc = parse(GetUncompressedData(data),s_table)
-      attachments[id] = {'html': render_table(doc['version'][0]['data']) }
-    elif typ == 'public.url':
-      # there is a preview image somewhere too, but not sure I care
-      attachments[id] = {'html': E('a',{'href':url},title)}
-    elif fname:
-      fn = os.path.join(root,'Media',id2,fname)
-      att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
-      if typ in ['public.tiff','public.jpeg','public.png']:
-        attachments[id] = {'html': E('img',{'src':att_url})}
-      else:
-        # e.g. com.adobe.pdf
-        attachments[id] = {'html': E('a',{'href':att_url},fname)}
+# Attachment types rendered from their ZMERGEABLEDATA
+DATA_TYPES = ('com.apple.drawing', 'com.apple.notes.table')
+
+def RenderAttachment(root, id, data, typ, id2, fname, url, title, drawing=None, media=None, max_size=None):
+  """Render one ZICCLOUDSYNCINGOBJECT attachment row to {'html': element}.
+
+  Drawings rendered with non-default DrawingOptions also get 'path_bytes',
+  the path data size before and after simplification. If media is a
+  mediaindex.MediaIndex of root, fallback images are looked up in it rather
+  than on disk. A drawing or table whose data inflates past max_size bytes
+  is rendered as a placeholder and gets 'oversized'."""
+  if url is None:
+    url = ''
+  if title is None:
+    title = ''
+  if typ in DATA_TYPES and data:
+    try:
+      data = GetUncompressedData(data, max_size)
+    except NoteTooLarge:
+      text = '[%s attachment larger than %d bytes not rendered]' % (typ, max_size)
+      return {'html': E('span',{'class':'oversized'},text), 'oversized': True}
+  if typ == 'com.apple.drawing' and data:
+    doc = parse(data,s_drawing)
+    if drawing is None or drawing.is_default():
+      return {'html': svg(doc['version'][0]['data'])}
+    stats = [0, 0]
+    return {'html': svg(doc['version'][0]['data'], drawing, stats), 'path_bytes': stats}
+  elif typ == 'com.apple.notes.table' and data:
+    doc = parse(data,s_table)
+    return {'html': render_table(doc['version'][0]['data']) }
+  elif typ == 'public.url':
+    # there is a preview image somewhere too, but not sure I care
+    return {'html': E('a',{'href':url},title)}
+  elif fname:
+    fn = os.path.join(root,'Media',id2,fname)
+    att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
+    if typ in ['public.tiff','public.jpeg','public.png']:
+      return {'html': E('img',{'src':att_url})}
+    else:
+      # e.g. com.adobe.pdf
+      return {'html': E('a',{'href':att_url},fname)}
+  else:
+    fn = os.path.join(root,'FallbackImages',id+'.jpg')
+    att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
+    if media is not None:
+      found = media.exists(fn)
+    else:
+      found = os.path.exists(fn)
+    if found:
+      return {'html': E('img',{'src':att_url})}
     else:
-      fn = os.path.join(root,'FallbackImages',id+'.jpg')
+      fn = os.path.join(root,'Media',id,'missing.txt')
       att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
-      if os.path.exists(fn):
-        attachments[id] = {'html': E('img',{'src':att_url})}
+      return {'html': E('a',{'href':att_url},att_url)}
+
+class Attachments:
+  """Maps attachment identifiers to {'html': element}, rendering on first lookup.
+
+  Only the attachment metadata is held up front, as rows of (Z_PK, type,
+  media identifier, file name, URL, title). The ZMERGEABLEDATA of a drawing
+  or table is fetched by Z_PK, then decompressed and rendered, when a note
+  first refers to it, and the most recently used fragments are kept in an
+  LRU of maxsize entries.
+
+  The map is pickled to decode workers without its connection; a worker
+  opens source read-only, with the notesinput.InputOptions in
+  input_options, the first time it needs attachment data.
+
+  path_bytes counts the drawing path data rendered by this copy of the map,
+  before and after the DrawingOptions were applied.
+
+  media is an optional mediaindex.MediaIndex of root answering which
+  attachment files exist. max_size caps the inflated size of drawing and
+  table data, as the per-note ceiling does for note bodies.
+  """
+
+  def __init__(self, root, maxsize=256, drawing=None, media=None, db=None, source=None, max_size=None, input_options=None):
+    self.root = root
+    self.input_options = input_options
+    self.max_size = max_size
+    self.db = db
+    self.source = source
+    self.maxsize = maxsize
+    if drawing is None:
+      drawing = DrawingOptions()
+    self.drawing = drawing
+    self.media = media
+    self.path_bytes = [0, 0]
+    self.rows = {}
+    self.rendered = collections.OrderedDict()
+    self.digests = {}
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['db'] = None
+    return state
+
+  def add(self, id, row):
+    self.rows[id] = row
+
+  def data(self, id):
+    "Returns the ZMERGEABLEDATA of an attachment if its rendering uses it, otherwise None"
+    row = self.rows[id]
+    if row[1] not in DATA_TYPES:
+      return None
+    if self.db is None:
+      if self.source is None:
+        return None
+      self.db = notesinput.connect(self.source, self.input_options)
+    found = self.db.execute('select zmergeabledata from ziccloudsyncingobject where z_pk = ?', (row[0],)).fetchone()
+    if found is None:
+      return None
+    return found[0]
+
+  def digest(self, id):
+    "Returns a hash of everything the rendering of an attachment depends on, or None if it is unknown"
+    if id not in self.digests:
+      row = self.rows.get(id)
+      if row is None:
+        self.digests[id] = None
       else:
-        fn = os.path.join(root,'Media',id,'missing.txt')
-        att_url = urllib.parse.urlunsplit(('file', '', fn, '', ''))
-        attachments[id] = {'html': E('a',{'href':att_url},att_url)}
-    # html = attachments[id]['html']
-    # if html is None:
-    #   html = 'None'
-    #print("ATTACHMENT: %s HTML: %s" % (id, ET.tostring(html,method='html')))
+        h = hashlib.sha1(self.root.encode('utf8'))
+        if row[1] == 'com.apple.drawing' and not self.drawing.is_default():
+          h.update(b'\0' + self.drawing.key().encode('ascii'))
+        if row[1] in DATA_TYPES and self.max_size is not None:
+          h.update(b'\3' + str(self.max_size).encode('ascii'))
+        if self.media is not None and self.media.fallback_image(id) is not None:
+          h.update(b'\2')
+        for value in (self.data(id),) + tuple(row[1:]):
+          if value is None:
+            h.update(b'\1')
+          else:
+            if isinstance(value, str):
+              value = value.encode('utf8')
+            h.update(b'\0' + str(len(value)).encode('ascii') + b':' + value)
+        self.digests[id] = h.hexdigest()
+    return self.digests[id]
+
+  def get(self, id, default=None):
+    attach = self.rendered.get(id)
+    if attach is not None:
+      self.rendered.move_to_end(id)
+      return attach
+    row = self.rows.get(id)
+    if row is None:
+      return default
+    attach = RenderAttachment(self.root, id, self.data(id), *row[1:], drawing=self.drawing, media=self.media, max_size=self.max_size)
+    if 'path_bytes' in attach:
+      self.path_bytes[0] += attach['path_bytes'][0]
+      self.path_bytes[1] += attach['path_bytes'][1]
+    self.rendered[id] = attach
+    if len(self.rendered) > self.maxsize:
+      self.rendered.popitem(last=False)
+    return attach
+
+  def __getitem__(self, id):
+    attach = self.get(id)
+    if attach is None:
+      raise KeyError(id)
+    return attach
+
+  def __contains__(self, id):
+    return id in self.rows
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def keys(self):
+    return self.rows.keys()
+
+def GroupContainer(user):
+  "Returns the Notes group container of a user, the root of the attachment files"
+  return '/Users/' + user + '/Library/Group Containers/group.com.apple.notes'
+
+def ReadAttachments(db, source, user, maxsize=256, drawing=None, media=None, max_size=None, input_options=None):
+  """Returns an Attachments map of the attachment rows; nothing is rendered until looked up.
+
+  With a mediaindex.MediaIndex the attachment files are resolved under its
+  root instead of the user's group container. Drawings and tables that
+  inflate past max_size bytes are rendered as placeholders. Decode workers
+  open source with input_options to read attachment data."""
+  if media is not None:
+    root = media.root
+  else:
+    root = GroupContainer(user)
+  mquery = '''select a.z_pk, a.zidentifier, a.ztypeuti, b.zidentifier, b.zfilename, a.zurlstring,a.ztitle
+    from ziccloudsyncingobject a left join ziccloudsyncingobject b on a.zmedia = b.z_pk
+    where a.zcryptotag is null and a.ztypeuti is not null'''
+  attachments = Attachments(root, maxsize, drawing, media, db, source, max_size, input_options)
+  for pk, id, typ, id2, fname, url,title in db.execute(mquery):
+    attachments.add(id, (pk, typ, id2, fname, url, title))
+  return attachments
 
 def PrintAttachments(attachments):
   for key in attachments.keys():
@@ -422,12 +1026,73 @@ def PrintAttachments(attachments):
 
 # for id,data in db.execute(nquery):
 
-def ProcessNoteBodyBlob(blob, css, attachments):
+def note_plain_text(note):
+  "Returns the text of a parsed note, without the placeholders of its attachments"
+  if note is None:
+    return ''
+  return note.get('string', '').replace('\ufffc', '')
+
+def ProcessNoteBodyText(blob):
+  "Returns the plain text of a note body without rendering it"
+  if blob is None:
+    return ''
+  return note_plain_text(parse(blob,s_doc)['version'][0]['data'])
+
+def ProcessNoteBodyBlob(blob, css, attachments, timings=None, text=None):
+  """timings, if given, is a dict that receives the seconds spent in each stage;
+  text, if given, is a list the note's plain text is appended to"""
   if blob is None:
     return ''
   pb = blob
+  if timings is not None:
+    started = time.perf_counter()
   doc = parse(pb,s_doc)['version'][0]['data']
+  if text is not None:
+    text.append(note_plain_text(doc))
+  if timings is not None:
+    parsed = time.perf_counter()
   section = render_html(doc,attachments)
   section.tag = 'section'
   hdoc = E('html',E('head',E('style',css)),E('body',section))
-  return ET.tostring(hdoc,method='html')
+  if timings is not None:
+    rendered = time.perf_counter()
+  html = ET.tostring(hdoc,method='html')
+  if timings is not None:
+    timings['parse'] = parsed - started
+    timings['render_html'] = rendered - parsed
+    timings['tostring'] = time.perf_counter() - rendered
+  return html
+
+def ProcessNoteBodyBlobStream(blob, css, attachments, timings=None, text=None):
+  "Same result as ProcessNoteBodyBlob, rendered with render_html_stream"
+  if blob is None:
+    return ''
+  if timings is not None:
+    started = time.perf_counter()
+  doc = parse(blob,s_doc)['version'][0]['data']
+  if text is not None:
+    text.append(note_plain_text(doc))
+  if timings is not None:
+    parsed = time.perf_counter()
+  out = []
+  write = out.append
+  write('<html><head><style>')
+  if css:
+    write(css)
+  write('</style></head><body>')
+  render_html_stream(doc, attachments, write, 'section')
+  write('</body></html>')
+  if timings is not None:
+    rendered = time.perf_counter()
+  html = ''.join(out).encode('us-ascii', 'xmlcharrefreplace')
+  if timings is not None:
+    timings['parse'] = parsed - started
+    timings['render_html'] = rendered - parsed
+    timings['tostring'] = time.perf_counter() - rendered
+  return html
+
+# Note body renderers selectable with readnotes --renderer
+RENDERERS = {
+  'etree': ProcessNoteBodyBlob,
+  'stream': ProcessNoteBodyBlobStream,
+}
@@ -2,9 +2,16 @@ import os
 import argparse
 import sys
 import sqlite3
+import time
+import zlib
 
 import constants
 
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 #
 # MIT License
 #
@@ -30,6 +37,78 @@ import constants
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+#
+# Compressed storage of the rendered note bodies (Data in mac_apt.db;
+# apple_data, note_data and email_body in notes). A compressed value is
+# stored as a BLOB that starts with a NUL byte, a codec letter and a letter
+# for the type it was written as ('t' for TEXT, 'b' for BLOB), so every row
+# says how it was compressed and uncompressed rows can sit beside it; note
+# HTML never starts with a NUL byte. Reads go through decompress_value(), or
+# the notes_decompress() SQL function once register_functions() was called
+# on the connection.
+#
+CODEC_ZLIB = 'zlib'
+CODEC_ZSTD = 'zstd'
+
+CODEC_MARKERS = {
+  CODEC_ZLIB: b'\x00z',
+  CODEC_ZSTD: b'\x00s',
+}
+
+# Shorter values are stored as they are
+COMPRESS_MIN_SIZE = 64
+
+def available_codecs():
+  codecs = [CODEC_ZLIB]
+  if zstandard is not None:
+    codecs.append(CODEC_ZSTD)
+  return codecs
+
+def compress_value(value, codec=CODEC_ZLIB):
+  '''Returns the stored form of a TEXT or BLOB value; values that do not shrink are returned unchanged'''
+  if codec is None or value is None or len(value) < COMPRESS_MIN_SIZE:
+    return value
+  if isinstance(value, str):
+    data = value.encode('utf8')
+    kind = b't'
+  elif isinstance(value, bytes):
+    data = value
+    kind = b'b'
+  else:
+    return value
+  if codec == CODEC_ZSTD:
+    packed = zstandard.compress(data)
+  else:
+    packed = zlib.compress(data)
+  header = CODEC_MARKERS[codec] + kind
+  if len(header) + len(packed) >= len(data):
+    return value
+  return header + packed
+
+def decompress_value(value):
+  '''Returns the value written to compress_value, or the value itself if it was not compressed'''
+  if not isinstance(value, bytes) or value[:1] != b'\x00':
+    return value
+  marker = value[:2]
+  kind = value[2:3]
+  if kind not in (b't', b'b'):
+    return value
+  if marker == CODEC_MARKERS[CODEC_ZLIB]:
+    data = zlib.decompress(value[3:])
+  elif marker == CODEC_MARKERS[CODEC_ZSTD]:
+    if zstandard is None:
+      raise RuntimeError('value is compressed with zstd but the zstandard package is not installed')
+    data = zstandard.decompress(value[3:])
+  else:
+    return value
+  if kind == b't':
+    return data.decode('utf8')
+  return data
+
+def register_functions(sqlconn):
+  '''Adds notes_decompress(value) to a connection'''
+  sqlconn.create_function('notes_decompress', 1, decompress_value, deterministic=True)
+
 joplinColumns = [
   "joplin_id",
   "joplin_parent_id",
@@ -98,7 +177,62 @@ joplinColumnTypes = [
 	"TEXT"
 ]
 
-def create_database(sqlconn, db_schema_version, email_address):
+NOTES_INDEXES = [
+  ('hashidx', '''CREATE INDEX IF NOT EXISTS "hashidx" ON "notes" (
+    "note_hash"
+  );'''),
+  ('dateidx', '''CREATE INDEX IF NOT EXISTS "dateidx" ON "notes" (
+    "note_internal_date"
+  );'''),
+  ('typeidx', '''CREATE INDEX IF NOT EXISTS "typeidx" ON "notes" (
+    "note_type"
+  );'''),
+  ('applefolderidx', '''CREATE INDEX IF NOT EXISTS "applefolderidx" ON "notes" (
+    "apple_folder"
+  );'''),
+  ('appleaccountidx', '''CREATE INDEX IF NOT EXISTS "appleaccountidx" ON "notes" (
+    "apple_account_identifier"
+  );'''),
+]
+
+# A note has one row per attachment, and one row with a NULL AttachmentID if
+# it has none; NULLs are distinct in a UNIQUE index, so the key indexes ''
+# in their place. The key is not deferred by a bulk load since the upserts
+# need it.
+MACAPT_KEY = [
+  ('notekey', '''CREATE UNIQUE INDEX IF NOT EXISTS "notekey" ON "Notes" (
+    "Source",
+    "ID",
+    ifnull("AttachmentID", '')
+  );'''),
+]
+
+MACAPT_INDEXES = [
+  ('folderidx', '''CREATE INDEX IF NOT EXISTS "folderidx" ON "Notes" (
+    "Folder"
+  );'''),
+  ('modifiedidx', '''CREATE INDEX IF NOT EXISTS "modifiedidx" ON "Notes" (
+    "LastModified"
+  );'''),
+  ('accountidx', '''CREATE INDEX IF NOT EXISTS "accountidx" ON "Notes" (
+    "AccountIdentifier"
+  );'''),
+]
+
+# Stored in PRAGMA user_version; 0 is the original table without a key
+MACAPT_SCHEMA_VERSION = 1
+
+def create_indexes(sqlconn, indexes):
+  for name, sql in indexes:
+    sqlconn.execute(sql)
+  sqlconn.commit()
+
+def drop_indexes(sqlconn, indexes):
+  for name, sql in indexes:
+    sqlconn.execute('DROP INDEX IF EXISTS "%s";' % (name,))
+  sqlconn.commit()
+
+def create_database(sqlconn, db_schema_version, email_address, indexes=True):
   print("creating database...")
   sqlconn.execute('''CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT);''')
   sqlconn.execute('''INSERT INTO settings (name, value) VALUES (?, ?);''',
@@ -179,13 +313,9 @@ def create_database(sqlconn, db_schema_version, email_address):
 	"joplin_file_extension" TEXT,
   PRIMARY KEY("note_id")
   );''')
-  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "hashidx" ON "notes" (
-    "note_hash"
-  );''')
-  sqlconn.execute('''CREATE INDEX IF NOT EXISTS "dateidx" ON "notes" (
-    "note_internal_date"
-  );''')
   sqlconn.commit()
+  if indexes:
+    create_indexes(sqlconn, NOTES_INDEXES)
 
 #
 # Use settings schema from gyb2eml
@@ -208,7 +338,7 @@ database schema while this program %s requires version %s - %s"
 db_schema_version))
     sys.exit(4)
 
-def create_macapt_database(sqlconn):
+def create_macapt_database(sqlconn, indexes=True):
   print("creating database...")
   sqlconn.execute('''CREATE TABLE IF NOT EXISTS "Notes" (
   "ID"  INTEGER,
@@ -227,10 +357,219 @@ def create_macapt_database(sqlconn):
   "User"  TEXT,
   "Source"  TEXT
   );''')
+  create_indexes(sqlconn, MACAPT_KEY)
+  sqlconn.execute('PRAGMA user_version = %d;' % (MACAPT_SCHEMA_VERSION,))
   sqlconn.commit()
+  if indexes:
+    create_indexes(sqlconn, MACAPT_INDEXES)
 
-def add_macapt_note(sqlconn, columns):
-  sqlconn.execute('''INSERT INTO Notes (ID,
+def migrate_macapt_database(sqlconn):
+  '''Adds the key and indexes to a database created by an older version; returns True if it did'''
+  version = sqlconn.execute('PRAGMA user_version;').fetchone()[0]
+  if version >= MACAPT_SCHEMA_VERSION:
+    return False
+  print("migrating database...")
+  # Runs without the key appended a copy of every row; keep the newest one
+  sqlconn.execute('''DELETE FROM Notes WHERE rowid NOT IN (
+  SELECT max(rowid) FROM Notes GROUP BY Source, ID, ifnull(AttachmentID, ''));''')
+  create_indexes(sqlconn, MACAPT_KEY)
+  create_indexes(sqlconn, MACAPT_INDEXES)
+  sqlconn.execute('PRAGMA user_version = %d;' % (MACAPT_SCHEMA_VERSION,))
+  sqlconn.commit()
+  return True
+
+#
+# The normalised schema stores each note once in NoteRecords and the rows
+# that differ per attachment in NoteAttachments; a note without attachments
+# has one NoteAttachments row with a NULL AttachmentID, as it has one row in
+# the flat table. The Notes view joins them back into the flat shape.
+#
+NORMALIZED_KEY = [
+  ('attachmentkey', '''CREATE UNIQUE INDEX IF NOT EXISTS "attachmentkey" ON "NoteAttachments" (
+    "Source",
+    "ID",
+    ifnull("AttachmentID", '')
+  );'''),
+]
+
+NORMALIZED_INDEXES = [
+  ('recordfolderidx', '''CREATE INDEX IF NOT EXISTS "recordfolderidx" ON "NoteRecords" (
+    "Folder"
+  );'''),
+  ('recordmodifiedidx', '''CREATE INDEX IF NOT EXISTS "recordmodifiedidx" ON "NoteRecords" (
+    "LastModified"
+  );'''),
+  ('recordaccountidx', '''CREATE INDEX IF NOT EXISTS "recordaccountidx" ON "NoteRecords" (
+    "AccountIdentifier"
+  );'''),
+]
+
+def create_macapt_normalized_database(sqlconn, indexes=True):
+  print("creating database...")
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "NoteRecords" (
+  "ID"  INTEGER,
+  "Title"  TEXT,
+  "Snippet"  TEXT,
+  "Folder"  TEXT,
+  "Created"  TEXT,
+  "LastModified"  TEXT,
+  "Data"  TEXT,
+  "AccountDescription"  TEXT,
+  "AccountIdentifier"  TEXT,
+  "AccountUsername"  TEXT,
+  "Version"  TEXT,
+  "User"  TEXT,
+  "Source"  TEXT,
+  PRIMARY KEY("Source", "ID")
+  );''')
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "NoteAttachments" (
+  "Source"  TEXT,
+  "ID"  INTEGER,
+  "AttachmentID"  TEXT,
+  "AttachmentPath"  TEXT
+  );''')
+  sqlconn.execute('''CREATE VIEW IF NOT EXISTS "Notes" AS SELECT
+  r.ID AS ID,
+  r.Title AS Title,
+  r.Snippet AS Snippet,
+  r.Folder AS Folder,
+  r.Created AS Created,
+  r.LastModified AS LastModified,
+  r.Data AS Data,
+  a.AttachmentID AS AttachmentID,
+  a.AttachmentPath AS AttachmentPath,
+  r.AccountDescription AS AccountDescription,
+  r.AccountIdentifier AS AccountIdentifier,
+  r.AccountUsername AS AccountUsername,
+  r.Version AS Version,
+  r.User AS User,
+  r.Source AS Source
+  FROM NoteRecords AS r
+  JOIN NoteAttachments AS a ON a.Source = r.Source AND a.ID = r.ID;''')
+  create_indexes(sqlconn, NORMALIZED_KEY)
+  sqlconn.execute('PRAGMA user_version = %d;' % (MACAPT_SCHEMA_VERSION,))
+  sqlconn.commit()
+  if indexes:
+    create_indexes(sqlconn, NORMALIZED_INDEXES)
+
+def is_macapt_normalized(sqlconn):
+  '''True if the database was created with the normalised schema'''
+  row = sqlconn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'NoteRecords';''').fetchone()
+  return row is not None
+
+#
+# Full-text search keeps the plain text of each note in NoteText, one row per
+# (Source, ID), and indexes its title and text in the NoteTextFTS external
+# content FTS5 table. The triggers keep the index in step with every insert,
+# update, upsert and delete on NoteText.
+#
+def has_fts5(sqlconn):
+  '''True if the SQLite library was built with FTS5'''
+  options = [row[0] for row in sqlconn.execute('PRAGMA compile_options;')]
+  return 'ENABLE_FTS5' in options
+
+def create_macapt_fts_tables(sqlconn):
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "NoteText" (
+  "TextID"  INTEGER PRIMARY KEY,
+  "Source"  TEXT,
+  "ID"  INTEGER,
+  "Title"  TEXT,
+  "Text"  TEXT,
+  UNIQUE("Source", "ID")
+  );''')
+  sqlconn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS "NoteTextFTS" USING fts5(
+  "Title",
+  "Text",
+  content='NoteText',
+  content_rowid='TextID',
+  tokenize='unicode61 remove_diacritics 2'
+  );''')
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "NoteTextInsert" AFTER INSERT ON "NoteText" BEGIN
+  INSERT INTO NoteTextFTS (rowid, Title, Text) VALUES (new.TextID, new.Title, new.Text);
+  END;''')
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "NoteTextDelete" AFTER DELETE ON "NoteText" BEGIN
+  INSERT INTO NoteTextFTS (NoteTextFTS, rowid, Title, Text) VALUES ('delete', old.TextID, old.Title, old.Text);
+  END;''')
+  sqlconn.execute('''CREATE TRIGGER IF NOT EXISTS "NoteTextUpdate" AFTER UPDATE ON "NoteText" BEGIN
+  INSERT INTO NoteTextFTS (NoteTextFTS, rowid, Title, Text) VALUES ('delete', old.TextID, old.Title, old.Text);
+  INSERT INTO NoteTextFTS (rowid, Title, Text) VALUES (new.TextID, new.Title, new.Text);
+  END;''')
+  sqlconn.commit()
+
+def has_macapt_fts_tables(sqlconn):
+  row = sqlconn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'NoteTextFTS';''').fetchone()
+  return row is not None
+
+NOTE_TEXT_SQL = '''INSERT INTO NoteText (Source, ID, Title, Text) VALUES (?, ?, ?, ?)
+  ON CONFLICT (Source, ID) DO UPDATE SET
+  Title = excluded.Title,
+  Text = excluded.Text;'''
+
+def search_notes(sqlconn, query, limit=20, source=None, marks=('[', ']'), ellipsis='...', tokens=16):
+  '''Returns a list of tuple (source, note id, title, snippet, score), best match first.
+
+  query is an FTS5 query, e.g. 'apple AND pie' or '"apple pie"'; a lower
+  score is a better match. marks surround the matched terms in the snippet.
+  '''
+  sql = '''SELECT t.Source, t.ID, t.Title, snippet(NoteTextFTS, 1, ?, ?, ?, ?), NoteTextFTS.rank
+  FROM NoteTextFTS JOIN NoteText AS t ON t.TextID = NoteTextFTS.rowid
+  WHERE NoteTextFTS MATCH ?'''
+  params = [marks[0], marks[1], ellipsis, tokens, query]
+  if source is not None:
+    sql += ''' AND t.Source = ?'''
+    params.append(source)
+  sql += ''' ORDER BY NoteTextFTS.rank LIMIT ?;'''
+  params.append(limit)
+  return sqlconn.execute(sql, params).fetchall()
+
+#
+# Incremental imports keep the newest modification date seen per source and
+# a fingerprint (modification date and hash of ZDATA) per imported note.
+#
+def create_macapt_sync_tables(sqlconn):
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "SourceWatermarks" (
+  "Source"  TEXT,
+  "LastModified"  REAL,
+  "LastRun"  TEXT,
+  PRIMARY KEY("Source")
+  );''')
+  sqlconn.execute('''CREATE TABLE IF NOT EXISTS "NoteFingerprints" (
+  "Source"  TEXT,
+  "ID"  INTEGER,
+  "Modified"  REAL,
+  "Hash"  TEXT,
+  PRIMARY KEY("Source", "ID")
+  );''')
+  sqlconn.commit()
+
+def get_source_watermark(sqlconn, source):
+  '''Returns tuple (last_modified, last_run), or None if the source was never imported incrementally'''
+  return sqlconn.execute('''SELECT LastModified, LastRun FROM SourceWatermarks WHERE Source = ?;''', (source,)).fetchone()
+
+def get_note_fingerprints(sqlconn, source):
+  '''Returns dict mapping note ID to tuple (modified, hash)'''
+  cursor = sqlconn.execute('''SELECT ID, Modified, Hash FROM NoteFingerprints WHERE Source = ?;''', (source,))
+  return dict((row[0], (row[1], row[2])) for row in cursor)
+
+macaptColumns = [
+  "apple_id",
+  "apple_title",
+  "apple_snippet",
+  "apple_folder",
+  "apple_created",
+  "apple_last_modified",
+  "apple_data",
+  "apple_attachment_id",
+  "apple_attachment_path",
+  "apple_account_description",
+  "apple_account_identifier",
+  "apple_account_username",
+  "apple_version",
+  "apple_user",
+  "apple_source"
+]
+
+MACAPT_INSERT_SQL = '''INSERT INTO Notes (ID,
   Title,
   Snippet,
   Folder,
@@ -244,24 +583,240 @@ def add_macapt_note(sqlconn, columns):
   AccountUsername,
   Version,
   User,
-  Source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
-         (columns["apple_id"],
-          columns["apple_title"],
-          columns["apple_snippet"],
-          columns["apple_folder"],
-          columns["apple_created"],
-          columns["apple_last_modified"],
-          columns["apple_data"],
-          columns["apple_attachment_id"],
-          columns["apple_attachment_path"],
-          columns["apple_account_description"],
-          columns["apple_account_identifier"],
-          columns["apple_account_username"],
-          columns["apple_version"],
-          columns["apple_user"],
-          columns["apple_source"]))
+  Source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+  ON CONFLICT (Source, ID, ifnull(AttachmentID, '')) DO UPDATE SET
+  Title = excluded.Title,
+  Snippet = excluded.Snippet,
+  Folder = excluded.Folder,
+  Created = excluded.Created,
+  LastModified = excluded.LastModified,
+  Data = excluded.Data,
+  AttachmentID = excluded.AttachmentID,
+  AttachmentPath = excluded.AttachmentPath,
+  AccountDescription = excluded.AccountDescription,
+  AccountIdentifier = excluded.AccountIdentifier,
+  AccountUsername = excluded.AccountUsername,
+  Version = excluded.Version,
+  User = excluded.User;'''
+
+NORMALIZED_RECORD_SQL = '''INSERT INTO NoteRecords (ID,
+  Title,
+  Snippet,
+  Folder,
+  Created,
+  LastModified,
+  Data,
+  AccountDescription,
+  AccountIdentifier,
+  AccountUsername,
+  Version,
+  User,
+  Source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+  ON CONFLICT (Source, ID) DO UPDATE SET
+  Title = excluded.Title,
+  Snippet = excluded.Snippet,
+  Folder = excluded.Folder,
+  Created = excluded.Created,
+  LastModified = excluded.LastModified,
+  Data = excluded.Data,
+  AccountDescription = excluded.AccountDescription,
+  AccountIdentifier = excluded.AccountIdentifier,
+  AccountUsername = excluded.AccountUsername,
+  Version = excluded.Version,
+  User = excluded.User;'''
+
+NORMALIZED_ATTACHMENT_SQL = '''INSERT INTO NoteAttachments (Source,
+  ID,
+  AttachmentID,
+  AttachmentPath) VALUES (?, ?, ?, ?)
+  ON CONFLICT (Source, ID, ifnull(AttachmentID, '')) DO UPDATE SET
+  AttachmentID = excluded.AttachmentID,
+  AttachmentPath = excluded.AttachmentPath;'''
+
+def macapt_note_values(columns):
+  return tuple(columns[name] for name in macaptColumns)
+
+def split_macapt_values(values):
+  '''Returns tuple (record values, attachment values) of the normalised schema for a flat row'''
+  return values[0:7] + values[9:15], (values[14], values[0], values[7], values[8])
+
+def add_macapt_note(sqlconn, columns):
+  sqlconn.execute(MACAPT_INSERT_SQL, macapt_note_values(columns))
+
+def add_macapt_notes(sqlconn, columns_list):
+  sqlconn.executemany(MACAPT_INSERT_SQL, [macapt_note_values(columns) for columns in columns_list])
+
+#
+# Bulk loading trades durability for speed while a database is being filled:
+# the journal and fsyncs are turned off (or the journal moved to a WAL), the
+# page cache is enlarged and the secondary indexes are built once at the end
+# instead of row by row. finish() builds the indexes, runs ANALYZE and puts
+# the saved settings back; a load interrupted before then can leave the
+# database corrupt when the journal is off, so only use that for a new file.
+#
+class BulkLoad:
+  '''Bulk-load settings for one connection; call begin() before and finish() after the load'''
+
+  JOURNAL_MODES = ('WAL', 'OFF')
+
+  def __init__(self, sqlconn, indexes, journal_mode='WAL', cache_size=256 * 1024 * 1024, defer_indexes=True):
+    self.sqlconn = sqlconn
+    self.indexes = indexes
+    self.journal_mode = journal_mode
+    self.cache_size = cache_size
+    self.defer_indexes = defer_indexes
+    self.saved = None
+
+  def begin(self):
+    self.sqlconn.commit()
+    self.saved = dict((name, self.sqlconn.execute('PRAGMA %s;' % (name,)).fetchone()[0])
+      for name in ('journal_mode', 'synchronous', 'cache_size'))
+    self.sqlconn.execute('PRAGMA journal_mode = %s;' % (self.journal_mode,))
+    self.sqlconn.execute('PRAGMA synchronous = OFF;')
+    # A negative cache size is in KiB rather than pages
+    self.sqlconn.execute('PRAGMA cache_size = %d;' % (-(int(self.cache_size) // 1024),))
+    if self.defer_indexes:
+      drop_indexes(self.sqlconn, self.indexes)
+
+  def finish(self):
+    '''Builds the deferred indexes, runs ANALYZE and restores the saved settings'''
+    self.sqlconn.commit()
+    create_indexes(self.sqlconn, self.indexes)
+    self.sqlconn.execute('ANALYZE;')
+    self.sqlconn.commit()
+    if self.saved['journal_mode'].upper() != self.journal_mode:
+      if self.journal_mode == 'WAL':
+        self.sqlconn.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+      self.sqlconn.execute('PRAGMA journal_mode = %s;' % (self.saved['journal_mode'],))
+    self.sqlconn.execute('PRAGMA synchronous = %d;' % (self.saved['synchronous'],))
+    self.sqlconn.execute('PRAGMA cache_size = %d;' % (self.saved['cache_size'],))
+
+class MacAptNoteBatch:
+  '''Buffers mac_apt notes and inserts them with executemany, one transaction per batch.
+
+  A crash loses at most the rows of the batch that has not been committed yet.
+  With normalized set the rows are written to NoteRecords and NoteAttachments;
+  the rows of one note share a record, which is written once per batch.
+  With codec set Data is compressed; raw_bytes, stored_bytes and
+  compress_seconds add up its cost and savings. The rows of a note share its
+  body, so it is compressed, and its sizes counted, once per note. With
+  full_text set the
+  plain text of each note (the apple_text column, when the reader provides
+  it) is written to NoteText once per batch.
+  '''
+
+  def __init__(self, sqlconn, batch_size=1000, timer=None, normalized=False, codec=None, full_text=False):
+    self.sqlconn = sqlconn
+    self.batch_size = max(int(batch_size), 1)
+    self.timer = timer
+    self.normalized = normalized
+    self.codec = codec
+    self.full_text = full_text
+    self.pending_text = {}
+    self.raw_bytes = 0
+    self.stored_bytes = 0
+    self.compress_seconds = 0.0
+    # (source, note id, data, stored) of the last body compressed
+    self.last_compressed = None
+    self.pending = []
+    self.pending_records = {}
+    self.pending_deletes = []
+    self.pending_fingerprints = []
+    self.pending_fingerprint_deletes = []
+
+  def add(self, columns):
+    values = macapt_note_values(columns)
+    if self.full_text:
+      key = (columns["apple_source"], columns["apple_id"])
+      self.pending_text[key] = key + (columns["apple_title"], columns.get("apple_text") or '')
+    if self.codec is not None:
+      values = self.compress(values)
+    if self.normalized:
+      record, values = split_macapt_values(values)
+      self.pending_records[(record[-1], record[0])] = record
+    self.pending.append(values)
+    if len(self.pending) >= self.batch_size:
+      self.flush()
+
+  def compress(self, values):
+    data = values[6]
+    last = self.last_compressed
+    if last is not None and last[0] == values[14] and last[1] == values[0] and last[2] == data:
+      # Another row of the note compressed last
+      return values[:6] + (last[3],) + values[7:]
+    started = time.perf_counter()
+    stored = compress_value(data, self.codec)
+    seconds = time.perf_counter() - started
+    self.compress_seconds += seconds
+    if self.timer is not None:
+      self.timer.add('compress', seconds)
+    if data is not None:
+      raw = len(data.encode('utf8')) if isinstance(data, str) else len(data)
+      self.raw_bytes += raw
+      self.stored_bytes += raw if stored is data else len(stored)
+    self.last_compressed = (values[14], values[0], data, stored)
+    return values[:6] + (stored,) + values[7:]
+
+  def delete_note(self, source, note_id):
+    '''Removes the rows of a note before the batch that re-inserts it'''
+    self.pending_deletes.append((source, note_id))
+
+  def delete_source(self, source):
+    self.flush()
+    if self.normalized:
+      self.sqlconn.execute('''DELETE FROM NoteRecords WHERE Source = ?;''', (source,))
+      self.sqlconn.execute('''DELETE FROM NoteAttachments WHERE Source = ?;''', (source,))
+    else:
+      self.sqlconn.execute('''DELETE FROM Notes WHERE Source = ?;''', (source,))
+    if self.full_text:
+      self.sqlconn.execute('''DELETE FROM NoteText WHERE Source = ?;''', (source,))
+
+  def set_fingerprint(self, source, note_id, modified, hash_):
+    self.pending_fingerprints.append((source, note_id, modified, hash_))
+
+  def delete_fingerprint(self, source, note_id):
+    '''Forgets a note that is no longer in its source'''
+    self.pending_fingerprint_deletes.append((source, note_id))
+
+  def set_watermark(self, source, modified):
+    self.flush()
+    self.sqlconn.execute('''INSERT OR REPLACE INTO SourceWatermarks (Source, LastModified, LastRun)
+  VALUES (?, ?, CURRENT_TIMESTAMP);''', (source, modified))
+    self.sqlconn.commit()
+
+  def flush(self):
+    if self.timer is not None:
+      started = time.perf_counter()
+    if self.pending_deletes:
+      if self.normalized:
+        self.sqlconn.executemany('''DELETE FROM NoteRecords WHERE Source = ? AND ID = ?;''', self.pending_deletes)
+        self.sqlconn.executemany('''DELETE FROM NoteAttachments WHERE Source = ? AND ID = ?;''', self.pending_deletes)
+      else:
+        self.sqlconn.executemany('''DELETE FROM Notes WHERE Source = ? AND ID = ?;''', self.pending_deletes)
+      if self.full_text:
+        self.sqlconn.executemany('''DELETE FROM NoteText WHERE Source = ? AND ID = ?;''', self.pending_deletes)
+      self.pending_deletes = []
+    if self.pending_records:
+      self.sqlconn.executemany(NORMALIZED_RECORD_SQL, self.pending_records.values())
+      self.pending_records = {}
+    if self.pending_text:
+      self.sqlconn.executemany(NOTE_TEXT_SQL, self.pending_text.values())
+      self.pending_text = {}
+    if self.pending:
+      self.sqlconn.executemany(NORMALIZED_ATTACHMENT_SQL if self.normalized else MACAPT_INSERT_SQL, self.pending)
+      self.pending = []
+    if self.pending_fingerprint_deletes:
+      self.sqlconn.executemany('''DELETE FROM NoteFingerprints WHERE Source = ? AND ID = ?;''', self.pending_fingerprint_deletes)
+      self.pending_fingerprint_deletes = []
+    if self.pending_fingerprints:
+      self.sqlconn.executemany('''INSERT OR REPLACE INTO NoteFingerprints (Source, ID, Modified, Hash)
+  VALUES (?, ?, ?, ?);''', self.pending_fingerprints)
+      self.pending_fingerprints = []
+    self.sqlconn.commit()
+    if self.timer is not None:
+      self.timer.add('insert', time.perf_counter() - started)
 
-def add_email_note(sqlconn, columns):
+def add_email_note(sqlconn, columns, codec=None):
   sqlconn.execute('''INSERT INTO notes (
   note_type,
   note_uuid,
@@ -292,7 +847,7 @@ def add_email_note(sqlconn, columns):
           columns["note_internal_date"],
           columns["note_hash"],
           columns["note_title"],
-          columns["note_data"],
+          compress_value(columns["note_data"], codec),
           columns["note_data_format"],
           columns["note_url"],
           columns["email_filename"],
@@ -306,9 +861,9 @@ def add_email_note(sqlconn, columns):
           columns["email_subject"],
           columns["email_x_universally_unique_identifier"],
           columns["email_message_id"],
-          columns["email_body"]))
+          compress_value(columns["email_body"], codec)))
 
-def add_apple_note(sqlconn, columns):
+def add_apple_note(sqlconn, columns, codec=None):
   sqlconn.execute('''INSERT INTO notes (
   note_type,
   note_uuid,
@@ -342,7 +897,7 @@ def add_apple_note(sqlconn, columns):
           columns["note_internal_date"],
           columns["note_hash"],
           columns["note_title"],
-          columns["note_data"],
+          compress_value(columns["note_data"], codec),
           columns["note_data_format"],
           columns["note_url"],
           columns["apple_id"],
@@ -351,7 +906,7 @@ def add_apple_note(sqlconn, columns):
           columns["apple_folder"],
           columns["apple_created"],
           columns["apple_last_modified"],
-          columns["apple_data"],
+          compress_value(columns["apple_data"], codec),
           columns["apple_attachment_id"],
           columns["apple_attachment_path"],
           columns["apple_account_description"],
@@ -361,7 +916,7 @@ def add_apple_note(sqlconn, columns):
           columns["apple_user"],
           columns["apple_source"]))
 
-def add_joplin_note(sqlconn, columns):
+def add_joplin_note(sqlconn, columns, codec=None):
   sqlconn.execute('''INSERT INTO notes (
   note_type,
   note_uuid,
@@ -430,7 +985,7 @@ def add_joplin_note(sqlconn, columns):
           columns["note_internal_date"],
           columns["note_hash"],
           columns["note_title"],
-          columns["note_data"],
+          compress_value(columns["note_data"], codec),
           columns["note_data_format"],
 					columns["note_url"],
           columns["apple_id"],
@@ -439,7 +994,7 @@ def add_joplin_note(sqlconn, columns):
           columns["apple_folder"],
           columns["apple_created"],
           columns["apple_last_modified"],
-          columns["apple_data"],
+          compress_value(columns["apple_data"], codec),
           columns["apple_attachment_id"],
           columns["apple_attachment_path"],
           columns["apple_account_description"],
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import tempfile
+import urllib.request
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Opens the input Notes databases for reading.
+#
+# Inputs are opened read-only through a URI, so a running Notes app is never
+# blocked by a writer lock and no journal or WAL file is created next to the
+# source. When the database has no journal, WAL or shared-memory file beside
+# it, it is also opened immutable, which skips file locking altogether. Any of
+# those files, even an empty one, means another connection may still write to
+# the database, so plain read-only (with locking) is used instead.
+#
+# The note queries are long scans of joined tables, so the connection gets a
+# large memory map and page cache. A live database can instead be copied into
+# memory with the backup API first; the copy is consistent and the source is
+# only locked while it is being copied. Decode worker processes cannot share
+# that copy, so they read a temporary file written from it instead.
+#
+
+MB = 1024 * 1024
+
+DEFAULT_MMAP_SIZE = 256 * MB
+DEFAULT_CACHE_SIZE = 64 * MB
+
+# Files SQLite keeps beside a database that is open or being written to
+SIDECAR_SUFFIXES = ('-wal', '-shm', '-journal')
+
+def input_uri(path, immutable=False):
+  '''Returns the read-only URI for a database file'''
+  uri = 'file:' + urllib.request.pathname2url(os.path.abspath(path)) + '?mode=ro'
+  if immutable:
+    uri += '&immutable=1'
+  return uri
+
+def is_quiescent(path):
+  '''True if no journal, WAL or shared-memory file is beside the database'''
+  for suffix in SIDECAR_SUFFIXES:
+    if os.path.lexists(path + suffix):
+      return False
+  return True
+
+def tune(conn, mmap_size=DEFAULT_MMAP_SIZE, cache_size=DEFAULT_CACHE_SIZE):
+  '''Sets the pragmas used for scanning an input database'''
+  conn.execute('PRAGMA query_only = 1')
+  conn.execute('PRAGMA temp_store = MEMORY')
+  conn.execute('PRAGMA mmap_size = %d' % (int(mmap_size),))
+  # A negative cache size is in KiB rather than pages
+  conn.execute('PRAGMA cache_size = %d' % (-(int(cache_size) // 1024),))
+
+def snapshot(conn):
+  '''Copies a database into memory with the backup API; returns the new connection'''
+  memory = sqlite3.connect(':memory:')
+  try:
+    conn.backup(memory)
+  except:
+    memory.close()
+    raise
+  return memory
+
+def snapshot_file(conn):
+  '''Writes a copy of a database to a temporary file; returns its path, which the caller removes'''
+  fd, path = tempfile.mkstemp(prefix='notes-snapshot-', suffix='.sqlite')
+  os.close(fd)
+  copy = sqlite3.connect(path)
+  try:
+    conn.backup(copy)
+  except:
+    copy.close()
+    os.remove(path)
+    raise
+  copy.close()
+  return path
+
+class InputOptions:
+  '''How input databases are opened.
+
+  immutable is 'auto' (immutable unless a journal, WAL or shared-memory
+  file is present), True or False. A snapshot is never read immutable, since
+  it is meant for databases that are being written to.
+  '''
+
+  def __init__(self, mmap_size=DEFAULT_MMAP_SIZE, cache_size=DEFAULT_CACHE_SIZE, snapshot=False, immutable='auto'):
+    self.mmap_size = mmap_size
+    self.cache_size = cache_size
+    self.snapshot = snapshot
+    self.immutable = immutable
+
+  def for_snapshot_file(self):
+    '''Options for reading a file written by snapshot_file, which nothing else writes to'''
+    return InputOptions(self.mmap_size, self.cache_size, False, True)
+
+  def is_immutable(self, path):
+    if self.snapshot:
+      # The copy is only consistent if the source is locked while it is read
+      return False
+    if self.immutable == 'auto':
+      return is_quiescent(path)
+    return bool(self.immutable)
+
+  def connect(self, path):
+    '''Opens a database for reading; raises sqlite3.Error if it cannot be read'''
+    conn = sqlite3.connect(input_uri(path, self.is_immutable(path)), uri=True)
+    try:
+      # Opening is lazy; read the schema so a bad file fails here
+      conn.execute('PRAGMA schema_version').fetchone()
+      if self.snapshot:
+        copy = snapshot(conn)
+        conn.close()
+        conn = copy
+      tune(conn, self.mmap_size, self.cache_size)
+    except:
+      conn.close()
+      raise
+    return conn
+
+def connect(path, options=None):
+  '''Opens a database for reading with the default options unless others are given'''
+  if options is None:
+    options = InputOptions()
+  return options.connect(path)
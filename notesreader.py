@@ -0,0 +1,200 @@
+import sqlite3
+from datetime import datetime
+
+import notesdb
+
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Streaming readers over the mac_apt.db Notes table (flat or normalised, see
+# notesdb) and the notesdb notes table.
+#
+# Rows are fetched a page at a time with keyset pagination: each page starts
+# after the sort key of the last row of the previous one, so a page costs the
+# same at the end of a table as at its start and only one page is in memory.
+# The key is the rowid, which is also the last column of every index, so an
+# equality filter on an indexed column is one index range scan; with a date
+# range the key is the date column and then the rowid.
+#
+# Only the columns asked for are read; by default the large body columns are
+# left out. Bodies stored compressed by notesdb are decompressed.
+#
+#   for note in read_macapt_notes(sqlconn, folder='Recipes', columns=['ID', 'Title', 'Data']):
+#     ...
+#
+
+DEFAULT_PAGE_SIZE = 500
+
+MACAPT_COLUMNS = [
+  "ID",
+  "Title",
+  "Snippet",
+  "Folder",
+  "Created",
+  "LastModified",
+  "Data",
+  "AttachmentID",
+  "AttachmentPath",
+  "AccountDescription",
+  "AccountIdentifier",
+  "AccountUsername",
+  "Version",
+  "User",
+  "Source"
+]
+
+MACAPT_BODY_COLUMNS = ["Data"]
+
+# Columns of the normalised schema that live in NoteAttachments
+NORMALIZED_ATTACHMENT_COLUMNS = ["AttachmentID", "AttachmentPath"]
+
+NOTES_BODY_COLUMNS = ["note_data", "apple_data", "email_body"]
+
+def _date_value(value):
+  '''Returns a date filter in the form the writers store dates in'''
+  if isinstance(value, datetime):
+    return value.isoformat(' ')
+  return value
+
+def _projection(columns, available, body_columns):
+  if columns is None:
+    return [name for name in available if name not in body_columns]
+  for name in columns:
+    if name not in available:
+      raise ValueError("unknown column '%s'" % (name,))
+  return list(columns)
+
+def _equals(expression, value, clauses, params):
+  '''Adds expression = value, or expression IN (...) for a list or tuple of values'''
+  if value is None:
+    return
+  if isinstance(value, (list, tuple)):
+    clauses.append('%s IN (%s)' % (expression, ', '.join('?' * len(value))))
+    params.extend(value)
+  else:
+    clauses.append('%s = ?' % (expression,))
+    params.append(value)
+
+def _date_range(expression, since, until, clauses, params):
+  '''Adds since <= expression < until; returns True if either bound was given'''
+  if since is not None:
+    clauses.append('%s >= ?' % (expression,))
+    params.append(_date_value(since))
+  if until is not None:
+    clauses.append('%s < ?' % (expression,))
+    params.append(_date_value(until))
+  return since is not None or until is not None
+
+def paginate(sqlconn, select, key, clauses, params, page_size=DEFAULT_PAGE_SIZE):
+  '''Yields the rows of select (which must start with the key expressions) in key order, page by page'''
+  last = None
+  order = ', '.join(key)
+  while True:
+    where = list(clauses)
+    args = list(params)
+    if last is not None:
+      where.append('(%s) > (%s)' % (order, ', '.join('?' * len(key))))
+      args.extend(last)
+    sql = select
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY %s LIMIT ?' % (order,)
+    args.append(page_size)
+    rows = sqlconn.execute(sql, args).fetchall()
+    for row in rows:
+      yield row
+    if len(rows) < page_size:
+      return
+    last = tuple(rows[-1][:len(key)])
+
+def _rows(rows, key, names, body_columns, decompress):
+  skip = len(key)
+  bodies = [index for index, name in enumerate(names) if name in body_columns] if decompress else []
+  for row in rows:
+    values = list(row[skip:])
+    for index in bodies:
+      values[index] = notesdb.decompress_value(values[index])
+    yield dict(zip(names, values))
+
+def read_macapt_notes(sqlconn, columns=None, folder=None, account=None, since=None, until=None,
+                      page_size=DEFAULT_PAGE_SIZE, decompress=True):
+  '''Yields a dict per row of the mac_apt Notes table, in rowid order.
+
+  columns defaults to every column but Data. folder and account (matched
+  against AccountIdentifier) take a value or a list of values; since and
+  until bound LastModified, since inclusive and until exclusive, and take a
+  datetime or a string such as '2020-01-31 00:00:00'. With a date range the
+  rows come in LastModified order.
+  '''
+  names = _projection(columns, MACAPT_COLUMNS, MACAPT_BODY_COLUMNS)
+  clauses = []
+  params = []
+  if notesdb.is_macapt_normalized(sqlconn):
+    # Read the tables behind the Notes view so the keyset predicate reaches their indexes
+    def column(name):
+      return ('a.' if name in NORMALIZED_ATTACHMENT_COLUMNS else 'r.') + name
+    source = '''NoteRecords AS r JOIN NoteAttachments AS a ON a.Source = r.Source AND a.ID = r.ID'''
+    key = ['r.rowid', "ifnull(a.AttachmentID, '')"]
+  else:
+    def column(name):
+      return name
+    source = 'Notes'
+    key = ['rowid']
+  _equals(column('Folder'), folder, clauses, params)
+  _equals(column('AccountIdentifier'), account, clauses, params)
+  if _date_range(column('LastModified'), since, until, clauses, params):
+    key.insert(0, column('LastModified'))
+  select = 'SELECT %s FROM %s' % (', '.join(key + [column(name) for name in names]), source)
+  rows = paginate(sqlconn, select, key, clauses, params, page_size)
+  return _rows(rows, key, names, MACAPT_BODY_COLUMNS, decompress)
+
+def read_notes(sqlconn, columns=None, folder=None, account=None, since=None, until=None, note_type=None,
+               page_size=DEFAULT_PAGE_SIZE, decompress=True):
+  '''Yields a dict per row of the notesdb notes table, in note_id order.
+
+  columns defaults to every column but note_data, apple_data and
+  email_body. folder matches apple_folder, account apple_account_identifier
+  and note_type note_type; each takes a value or a list of values. since and
+  until bound note_internal_date as in read_macapt_notes.
+  '''
+  available = [row[1] for row in sqlconn.execute('PRAGMA table_info(notes);')]
+  if not available:
+    raise sqlite3.OperationalError('no such table: notes')
+  names = _projection(columns, available, NOTES_BODY_COLUMNS)
+  clauses = []
+  params = []
+  key = ['note_id']
+  _equals('apple_folder', folder, clauses, params)
+  _equals('apple_account_identifier', account, clauses, params)
+  _equals('note_type', note_type, clauses, params)
+  if _date_range('note_internal_date', since, until, clauses, params):
+    key.insert(0, 'note_internal_date')
+  select = 'SELECT %s FROM notes' % (', '.join(key + ['"%s"' % (name,) for name in names]),)
+  rows = paginate(sqlconn, select, key, clauses, params, page_size)
+  return _rows(rows, key, names, NOTES_BODY_COLUMNS, decompress)
@@ -23,13 +23,28 @@ import hashlib
 import zlib
 import binascii
 
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import json
+import queue
+import threading
+import time
+
 import notesdb
 import common
+import rendercache
+import blobpack
+import timing
+import notesinput
+import mediaindex
 
 import urllib
 from biplist import *
 
-from notes2html import ReadAttachments, ProcessNoteBodyBlob, DefaultCss, PrintAttachments
+from notes2html import INFLATE_CHUNK_SIZE, NoteTooLarge, InflateChunks, InflateBounded
+from notes2html import ReadAttachments, GroupContainer, ProcessNoteBodyBlob, DefaultCss, PrintAttachments, DrawingOptions, RENDERERS, RENDERER_VERSION, ProcessNoteBodyText
 
 '''
    Copyright (c) 2017 Yogesh Khatri 
@@ -121,12 +136,15 @@ def ReadMacAbsoluteTime(mac_abs_time): # Mac Absolute time is time epoch beginni
       _log_error("ReadMacAbsoluteTime() Failed to convert timestamp from value " + str(mac_abs_time) + " Error was: " + str(ex))
   return ''
 
-def GetUncompressedData(compressed):
+def GetUncompressedData(compressed, max_size=None):
   if compressed == None:
     return None
   data = None
   try:
-    data = zlib.decompress(compressed, 15 + 32)
+    if max_size is None:
+      data = zlib.decompress(compressed, 15 + 32)
+    else:
+      data = InflateBounded(compressed, max_size)
   except zlib.error:
     _log_error('Zlib Decompression failed!')
   return data
@@ -186,17 +204,408 @@ def ProcessBasicNoteBodyBlob(blob):
     _log_error('Error processing note data blob')
   return data
 
-def ExecuteQuery(db, query):
+class InflateReader:
+  '''Reads a compressed note blob front to back, holding one chunk at a time'''
+
+  def __init__(self, compressed, chunk_size=INFLATE_CHUNK_SIZE):
+    self.chunks = InflateChunks(compressed, chunk_size)
+    self.buffer = b''
+    self.offset = 0
+    self.pos = 0
+
+  def read(self, n):
+    '''Returns up to n bytes; fewer only at the end of the stream'''
+    parts = []
+    while n > 0:
+      if self.offset >= len(self.buffer):
+        self.buffer = next(self.chunks, b'')
+        self.offset = 0
+        if not self.buffer:
+          break
+      part = self.buffer[self.offset:self.offset + n]
+      self.offset += len(part)
+      self.pos += len(part)
+      n -= len(part)
+      parts.append(part)
+    return b''.join(parts)
+
+  def skip(self, n):
+    while n > 0:
+      part = self.read(min(n, INFLATE_CHUNK_SIZE))
+      if not part:
+        raise EOFError()
+      n -= len(part)
+
+  def varint(self):
+    value = 0
+    shift = 0
+    while True:
+      b = self.read(1)
+      if not b:
+        raise EOFError()
+      value |= (b[0] & 0x7F) << shift
+      shift += 7
+      if b[0] < 0x80:
+        return value
+
+def SeekField(reader, end, field):
+  '''Skips to the first length-delimited field number field before end; returns its length or None'''
+  while end is None or reader.pos < end:
+    try:
+      key = reader.varint()
+    except EOFError:
+      return None
+    wire_type = key & 7
+    if wire_type == 0:
+      reader.varint()
+    elif wire_type == 1:
+      reader.skip(8)
+    elif wire_type == 5:
+      reader.skip(4)
+    elif wire_type == 2:
+      length = reader.varint()
+      if key >> 3 == field:
+        return length
+      reader.skip(length)
+    else:
+      raise ValueError('unsupported wire type %d' % (wire_type,))
+  return None
+
+def ReadNoteTextStream(compressed, max_size):
+  '''Text-only decode of a note too large to inflate in memory.
+
+  Walks document.version.data.string while decompressing and returns at most
+  max_size bytes of the note text; formatting and attachments are dropped.
+  '''
+  reader = InflateReader(compressed)
+  try:
+    end = None
+    for field in (2, 3, 2): # version, data, string
+      length = SeekField(reader, end, field)
+      if length is None:
+        _log_warning('Could not find note text in oversized note')
+        return ''
+      end = reader.pos + length
+    if length > max_size:
+      _log_warning('Note text truncated to %d bytes' % (max_size,))
+    return reader.read(min(length, max_size)).decode('utf-8', errors='ignore')
+  except (EOFError, ValueError, zlib.error):
+    _log_warning('Error reading text from oversized note')
+    return ''
+
+class NoteDecoder:
+  '''Decompresses a ZDATA blob and renders it to HTML.
+
+  Instances are pickled to worker processes, so they only hold plain data;
+  the timer stays behind and workers send their stage timings back in info.
+  With plain_text set the note's plain text is returned in info['text'].
+  '''
+
+  def __init__(self, css, attachments, keep_data=False, cache=None, timer=None, max_size=None, renderer='etree', plain_text=False):
+    self.css = css
+    self.attachments = attachments
+    self.keep_data = keep_data
+    self.cache = cache
+    self.timer = timer
+    self.profile = timer is not None
+    self.max_size = max_size
+    self.renderer = renderer
+    self.plain_text = plain_text
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['timer'] = None
+    return state
+
+  def decode(self, compressed):
+    '''Returns tuple (data, text_content, info); data is None unless keep_data is set.
+
+    info holds results that must be handed back to the main process with record().
+    A note that inflates past max_size is read text-only and flagged info['oversized'].
+    '''
+    info = {}
+    timings = None
+    if self.profile:
+      timings = info['timings'] = {}
+      started = timing.clock()
+    path_bytes = list(self.attachments.path_bytes)
+    try:
+      data = GetUncompressedData(compressed, self.max_size)
+    except NoteTooLarge:
+      _log_warning('Note inflates to more than %d bytes; only processing text' % (self.max_size,))
+      info['oversized'] = True
+      text_content = ReadNoteTextStream(compressed, self.max_size)
+      if self.plain_text:
+        info['text'] = text_content.replace('\ufffc', '')
+      if timings is not None:
+        timings['oversized'] = info['seconds'] = timing.clock() - started
+      return None, text_content, info
+    if timings is not None:
+      timings['decompress'] = timing.clock() - started
+    text_content = None
+    if self.cache is not None and data is not None:
+      if timings is not None:
+        looked_up = timing.clock()
+      key = self.cache.key(data, self.css, self.attachments.root)
+      text_content = self.cache.lookup(key, self.attachments)
+      if text_content is not None:
+        info['cache'] = ('hit', key)
+        if self.plain_text:
+          # Only the text is needed, so the note is parsed but not rendered
+          try:
+            info['text'] = ProcessNoteBodyText(data)
+          except KeyError:
+            info['text'] = ProcessBasicNoteBodyBlob(data)
+      if timings is not None:
+        timings['cache_lookup'] = timing.clock() - looked_up
+    if text_content is None:
+      text = [] if self.plain_text else None
+      try:
+        render = RENDERERS[self.renderer]
+        if self.cache is not None and data is not None:
+          recorder = rendercache.DependencyRecorder(self.attachments)
+          text_content = render(data, self.css, recorder, timings, text)
+          info['cache'] = ('miss', key, text_content, recorder.used)
+        else:
+          text_content = render(data, self.css, self.attachments, timings, text)
+      except KeyError:
+        _log_warning('Could not find version number; only processing text')
+        text_content = ProcessBasicNoteBodyBlob(data)
+        text = [text_content] if self.plain_text else None
+      if text:
+        info['text'] = text[0]
+    if not self.keep_data:
+      data = None
+    if self.attachments.path_bytes != path_bytes:
+      info['path_bytes'] = (self.attachments.path_bytes[0] - path_bytes[0],
+        self.attachments.path_bytes[1] - path_bytes[1])
+    if timings is not None:
+      info['seconds'] = timing.clock() - started
+    return data, text_content, info
+
+  def record(self, info):
+    '''Applies the side results of decode in the main process'''
+    if 'cache' in info:
+      self.cache.record(info['cache'])
+    if 'timings' in info:
+      self.timer.merge(info['timings'])
+    if 'path_bytes' in info:
+      self.attachments.drawing.original_bytes += info['path_bytes'][0]
+      self.attachments.drawing.rendered_bytes += info['path_bytes'][1]
+
+_worker_decoder = None
+
+def _InitDecodeWorker(decoder):
+  global _worker_decoder
+  _worker_decoder = decoder
+
+def _DecodeInWorker(compressed):
+  return _worker_decoder.decode(compressed)
+
+def GroupRowsByNote(cursor, timer=None):
+  '''Yields lists of consecutive rows that share a note and its ZDATA blob.
+
+  The note queries LEFT JOIN the attachments, so a note comes back once per
+  attachment; grouping lets the body be decoded once for all of those rows.
+  '''
+  groups = itertools.groupby(cursor, key=lambda row: (row['note_id'], row['data']))
+  if timer is None:
+    for key, rows in groups:
+      yield list(rows)
+    return
+  while True:
+    started = timing.clock()
+    try:
+      key, rows = next(groups)
+    except StopIteration:
+      return
+    rows = list(rows)
+    timer.add('fetch', timing.clock() - started)
+    yield rows
+
+def DecodeContext():
+  '''Returns a multiprocessing context that does not fork the calling process'''
+  if 'forkserver' in multiprocessing.get_all_start_methods():
+    return multiprocessing.get_context('forkserver')
+  return multiprocessing.get_context('spawn')
+
+def DecodeNotes(groups, decoder, workers=0):
+  '''Yields tuple (rows, data, text_content, info) for each group of rows, in order.
+
+  With workers > 0 the blobs are decoded on a process pool; at most
+  4 * workers notes are in flight so memory use stays flat. The pool is
+  only started once there is a note to decode.
+  '''
+  if workers <= 0:
+    for rows in groups:
+      data, text_content, info = decoder.decode(rows[0]['data'])
+      decoder.record(info)
+      yield rows, data, text_content, info
+    return
+
+  groups = iter(groups)
+  first = next(groups, None)
+  if first is None:
+    return
+  groups = itertools.chain((first,), groups)
+  # The pool is started from a reader thread while other threads hold locks
+  # (queues, stdout); a forked child could inherit one of them held forever
+  pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=DecodeContext(),
+    initializer=_InitDecodeWorker, initargs=(decoder,))
+  try:
+    inflight = collections.deque()
+    for rows in groups:
+      inflight.append((rows, pool.submit(_DecodeInWorker, rows[0]['data'])))
+      if len(inflight) >= workers * 4:
+        rows, future = inflight.popleft()
+        data, text_content, info = future.result()
+        decoder.record(info)
+        yield rows, data, text_content, info
+    while inflight:
+      rows, future = inflight.popleft()
+      data, text_content, info = future.result()
+      decoder.record(info)
+      yield rows, data, text_content, info
+  finally:
+    pool.shutdown(wait=True, cancel_futures=True)
+
+class NoteFingerprints:
+  '''Decides which notes of a source changed since the last incremental run.
+
+  A note is unchanged when its modification date and the hash of its
+  compressed ZDATA match the stored fingerprint. Notes not modified after the
+  source watermark are compared on the modification date alone: plan() reads
+  the id and date of every note without ZDATA, so the note query only fetches
+  the blobs of the other notes. Known notes the scan did not see were deleted
+  from the source and are removed by finish().
+  '''
+
+  def __init__(self, source, known, watermark, first_run):
+    self.source = source
+    self.known = known
+    self.watermark = watermark
+    self.first_run = first_run
+    self.latest = watermark
+    self.skipped = 0
+    self.changed = 0
+    self.deleted = []
+    self.current = {}
+    self.seen = set()
+    self.scanned = False
+
+  def plan(self, cursor):
+    '''Reads (note id, modified) for every note of the source.
+
+    Returns the ids of the notes whose rows must be read, or None if all of
+    them must be.
+    '''
+    wanted = []
+    total = 0
+    for note_id, modified in cursor:
+      total += 1
+      self.seen.add(note_id)
+      if modified is not None and (self.latest is None or modified > self.latest):
+        self.latest = modified
+      known = self.known.get(note_id)
+      if known is not None and known[0] == modified and \
+         self.watermark is not None and modified is not None and modified <= self.watermark:
+        self.skipped += 1
+        continue
+      wanted.append(note_id)
+    self.scanned = True
+    if len(wanted) == total:
+      return None
+    return wanted
+
+  def filter(self, groups):
+    for rows in groups:
+      row = rows[0]
+      note_id = row['note_id']
+      modified = row['modified']
+      self.seen.add(note_id)
+      if modified is not None and (self.latest is None or modified > self.latest):
+        self.latest = modified
+      known = self.known.get(note_id)
+      if known is not None and known[0] == modified:
+        if self.watermark is not None and modified is not None and modified <= self.watermark:
+          self.skipped += 1
+          continue
+        hash_ = self.hash(row['data'])
+        if known[1] == hash_:
+          self.skipped += 1
+          continue
+      else:
+        hash_ = self.hash(row['data'])
+      self.current[id(rows)] = (modified, hash_)
+      self.changed += 1
+      yield rows
+
+  def hash(self, data):
+    if data is None:
+      return ''
+    return hashlib.sha1(data).hexdigest()
+
+  def begin_note(self, rows, writer):
+    '''Replaces a changed note in place; call before its rows are written'''
+    if not self.first_run:
+      writer.delete_note(self.source, rows[0]['note_id'])
+
+  def end_note(self, rows, writer):
+    modified, hash_ = self.current.pop(id(rows))
+    writer.set_fingerprint(self.source, rows[0]['note_id'], modified, hash_)
+
+  def finish(self, writer):
+    if self.scanned:
+      for note_id in self.known:
+        if note_id not in self.seen:
+          writer.delete_note(self.source, note_id)
+          writer.delete_fingerprint(self.source, note_id)
+          self.deleted.append(note_id)
+    writer.set_watermark(self.source, self.latest)
+    print("incremental: %d changed note(s), %d unchanged note(s) skipped, %d deleted note(s) removed" % (self.changed, self.skipped, len(self.deleted)))
+
+def ChangedNotes(db, fingerprints, prepass, column):
+  '''Returns tuple (clause, params) limiting a note query to the notes that may have changed.
+
+  Returns None if no note has changed. prepass selects (note id, modified)
+  for every note and column is the note id in the note query.
+  '''
+  wanted = fingerprints.plan(db.execute(prepass))
+  if wanted is None:
+    return ('', ())
+  if len(wanted) == 0:
+    return None
+  return (' WHERE ' + column + ' IN (SELECT value FROM json_each(?)) ', (json.dumps(wanted),))
+
+def ExecuteQuery(db, query, params=()):
   '''Run query, return tuple (cursor, error_message)'''
   try:
     db.row_factory = sqlite3.Row
-    cursor = db.execute(query)
+    cursor = db.execute(query, params)
     return cursor, ""
   except sqlite3.Error as ex:
     error = str(ex)
   return None, error
 
-def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path):
+def ExecuteNoteQuery(db, query, fingerprints, prepass, column):
+  '''Runs a note query ordered by note id; returns tuple (cursor, error_message).
+
+  In incremental runs only the notes that may have changed are queried; if
+  none has, the cursor is an empty iterator.
+  '''
+  params = ()
+  if fingerprints is not None:
+    try:
+      changed = ChangedNotes(db, fingerprints, prepass, column)
+    except sqlite3.Error as ex:
+      return None, str(ex)
+    if changed is None:
+      return iter(()), ""
+    query += changed[0]
+    params = changed[1]
+  return ExecuteQuery(db, query + " ORDER BY note_id ", params)
+
+def ReadNotesHighSierra(db, source, user, css, attachments, odb, blobs, workers=0, fingerprints=None, cache=None, timer=None, max_size=None, renderer='etree', plain_text=False):
   '''Read Notestore.sqlite'''
   try:
     query = " SELECT n.Z_PK, n.ZNOTE as note_id, n.ZDATA as data, " \
@@ -211,39 +620,109 @@ def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path):
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c2 ON c2.Z_PK = c1.ZFOLDER "\
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE= n.ZNOTE "\
             " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c4.ZATTACHMENT1= c3.Z_PK "\
-            " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2  "\
-            " ORDER BY note_id  "
+            " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2  "
+    params = ()
+    if timer is not None:
+      started = timing.clock()
+    if fingerprints is not None:
+      changed = ChangedNotes(db, fingerprints,
+        " SELECT n.ZNOTE, c1.ZMODIFICATIONDATE1 FROM ZICNOTEDATA as n "\
+        " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c1 ON c1.ZNOTEDATA = n.Z_PK ", "n.ZNOTE")
+      if changed is None:
+        return
+      query += changed[0]
+      params = changed[1]
+    query += " ORDER BY note_id  "
     db.row_factory = sqlite3.Row
-    cursor = db.execute(query)
+    cursor = db.execute(query, params)
+    if timer is not None:
+      timer.add('query', timing.clock() - started)
+    decoder = NoteDecoder(css, attachments, keep_data=(blobs is not None), cache=cache, timer=timer, max_size=max_size, renderer=renderer, plain_text=plain_text)
+    groups = GroupRowsByNote(cursor, timer)
+    if fingerprints is not None:
+      groups = fingerprints.filter(groups)
+    for rows, data, text_content, info in DecodeNotes(groups, decoder, workers):
+      if timer is not None:
+        started = timing.clock()
+      if fingerprints is not None:
+        fingerprints.begin_note(rows, odb)
+      if blobs is not None:
+        if info.get('oversized'):
+          # Inflated again, chunk by chunk, on the blob writer thread
+          blobs.write(source, rows[0]['note_id'], InflateChunks(rows[0]['data']))
+        else:
+          blobs.write(source, rows[0]['note_id'], data)
+      for row in rows:
+        try:
+          att_path = ''
+          if row['att_uuid'] != None:
+            if user:
+              att_path = attachments.root + '/Media/' + row['att_uuid'] + '/' + row['ZFILENAME']
+            else:
+              att_path = 'Media/' + row['att_uuid'] + '/' + row['ZFILENAME']
+          columns = {}
+          columns["apple_id"] = row['note_id']
+          columns["apple_title"] = row['title']
+          columns["apple_snippet"] = row['snippet']
+          columns["apple_folder"] = row['folderName']
+          columns["apple_created"] = ReadMacAbsoluteTime(row['created'])
+          columns["apple_last_modified"] = ReadMacAbsoluteTime(row['modified'])
+          columns["apple_data"] = text_content
+          columns["apple_text"] = info.get('text')
+          columns["apple_attachment_id"] = row['att_uuid']
+          columns["apple_attachment_path"] = att_path
+          columns["apple_account_description"] = row['acc_name']
+          columns["apple_account_identifier"] = row['acc_identifier']
+          columns["apple_account_username"] = ''
+          columns["apple_version"] = 'NoteStore'
+          columns["apple_user"] = user
+          columns["apple_source"] = source
+          process_note(columns, odb)
+        except sqlite3.Error:
+          _log_error('Error fetching row data')
+      if fingerprints is not None:
+        fingerprints.end_note(rows, odb)
+      if timer is not None:
+        NoteTimed(timer, source, rows, info, timing.clock() - started)
+  except sqlite3.Error:
+    _log_error('Query  execution failed. Query was: ' + query)
+
+def IsHighSierraDb(db):
+  '''Returns false if Z_xxNOTE is a table where xx is a number'''
+  try:
+    cursor = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%NOTE%'")
     for row in cursor:
+      if row[0].startswith('Z_') and row[0].endswith('NOTES'):
+        return False
+  except sqlite3.Error as ex:
+    _log_error("Failed to list tables of db. Error Details:{}".format(str(ex)) )
+  return True
+
+def ReadQueryResults(cursor, user, source, css, attachments, odb, workers=0, fingerprints=None, cache=None, timer=None, max_size=None, renderer='etree', plain_text=False):
+  decoder = NoteDecoder(css, attachments, cache=cache, timer=timer, max_size=max_size, renderer=renderer, plain_text=plain_text)
+  groups = GroupRowsByNote(cursor, timer)
+  if fingerprints is not None:
+    groups = fingerprints.filter(groups)
+  for rows, data, text_content, info in DecodeNotes(groups, decoder, workers):
+    if timer is not None:
+      started = timing.clock()
+    if fingerprints is not None:
+      fingerprints.begin_note(rows, odb)
+    for row in rows:
       try:
         att_path = ''
-        if row['att_uuid'] != None:
-          if user:
-            att_path = '/Users/' + user + '/Library/Group Containers/group.com.apple.notes/Media/' + row['att_uuid'] + '/' + row['ZFILENAME']
-          else:
-            att_path = 'Media/' + row['att_uuid'] + '/' + row['ZFILENAME']
-        data = GetUncompressedData(row['data'])
-        if blob_path is not None:
-          with open(os.path.join(blob_path, str(row['note_id'])), 'wb') as f:
-            if data is None:
-              f.write(b'')
-            else:
-              f.write(data)
-            f.close()
-        try:
-          text_content = ProcessNoteBodyBlob(data, css, attachments)
-        except KeyError:
-          _log_warning('Could not find version number; only processing text ' + data.hex())
-          text_content = ProcessBasicNoteBodyBlob(data)
+        if row['media_id'] != None:
+            att_path = row['ZFILENAME']
+
         columns = {}
         columns["apple_id"] = row['note_id']
         columns["apple_title"] = row['title']
         columns["apple_snippet"] = row['snippet']
-        columns["apple_folder"] = row['folderName']
+        columns["apple_folder"] = row['folder']
         columns["apple_created"] = ReadMacAbsoluteTime(row['created'])
         columns["apple_last_modified"] = ReadMacAbsoluteTime(row['modified'])
         columns["apple_data"] = text_content
+        columns["apple_text"] = info.get('text')
         columns["apple_attachment_id"] = row['att_uuid']
         columns["apple_attachment_path"] = att_path
         columns["apple_account_description"] = row['acc_name']
@@ -255,61 +734,32 @@ def ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path):
         process_note(columns, odb)
       except sqlite3.Error:
         _log_error('Error fetching row data')
-  except sqlite3.Error:
-    _log_error('Query  execution failed. Query was: ' + query)
+    if fingerprints is not None:
+      fingerprints.end_note(rows, odb)
+    if timer is not None:
+      NoteTimed(timer, source, rows, info, timing.clock() - started)
 
-def IsHighSierraDb(db):
-  '''Returns false if Z_xxNOTE is a table where xx is a number'''
-  try:
-    cursor = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%NOTE%'")
-    for row in cursor:
-      if row[0].startswith('Z_') and row[0].endswith('NOTES'):
-        return False
-  except sqlite3.Error as ex:
-    _log_error("Failed to list tables of db. Error Details:{}".format(str(ex)) )
-  return True
+def NoteTimed(timer, source, rows, info, seconds):
+  '''Records the time spent writing a note's rows, and the note's total time'''
+  timer.add('rows', seconds)
+  timer.note(source, rows[0]['note_id'], info.get('seconds', 0) + seconds, info.get('timings'))
 
-def ReadQueryResults(cursor, user, source, css, attachments, odb):
-  for row in cursor:
-    try:
-      att_path = ''
-      if row['media_id'] != None:
-          att_path = row['ZFILENAME']
-      data = GetUncompressedData(row['data'])
-
-      try:
-        text_content = ProcessNoteBodyBlob(data, css, attachments)
-      except KeyError:
-        _log_warning('Could not find version number; only processing text')
-        text_content = ProcessBasicNoteBodyBlob(data)
+def ReadNotes(db, source, user, css, odb, blobs, workers=0, fingerprints=None, cache=None, timer=None, max_size=None, drawing=None, renderer='etree', plain_text=False, media=None, input_path=None, input_options=None):
+  '''Read Notestore.sqlite
 
-      columns = {}
-      columns["apple_id"] = row['note_id']
-      columns["apple_title"] = row['title']
-      columns["apple_snippet"] = row['snippet']
-      columns["apple_folder"] = row['folder']
-      columns["apple_created"] = ReadMacAbsoluteTime(row['created'])
-      columns["apple_last_modified"] = ReadMacAbsoluteTime(row['modified'])
-      columns["apple_data"] = text_content
-      columns["apple_attachment_id"] = row['att_uuid']
-      columns["apple_attachment_path"] = att_path
-      columns["apple_account_description"] = row['acc_name']
-      columns["apple_account_identifier"] = row['acc_identifier']
-      columns["apple_account_username"] = ''
-      columns["apple_version"] = 'NoteStore'
-      columns["apple_user"] = user
-      columns["apple_source"] = source
-      process_note(columns, odb)
-    except sqlite3.Error:
-      _log_error('Error fetching row data')
-
-def ReadNotes(db, source, user, css, odb, blob_path):
-  '''Read Notestore.sqlite'''
-  attachments = {}
-  ReadAttachments(db, attachments, source, user)
+  Decode workers read attachment data from input_path (default: source)
+  opened with input_options.
+  '''
+  if timer is not None:
+    started = timing.clock()
+  if input_path is None:
+    input_path = source
+  attachments = ReadAttachments(db, input_path, user, drawing=drawing, media=media, max_size=max_size, input_options=input_options)
+  if timer is not None:
+    timer.add('attachments', timing.clock() - started)
 
   if IsHighSierraDb(db):
-    ReadNotesHighSierra(db, source, user, css, attachments, odb, blob_path)
+    ReadNotesHighSierra(db, source, user, css, attachments, odb, blobs, workers, fingerprints, cache, timer, max_size, renderer, plain_text)
     return
 
   query1 = " SELECT n.Z_12FOLDERS as folder_id , n.Z_9NOTES as note_id, d.ZDATA as data, " \
@@ -324,8 +774,7 @@ def ReadNotes(db, source, user, css, odb, blob_path):
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c2 ON c2.Z_PK = n.Z_12FOLDERS " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE = n.Z_9NOTES " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c3.ZMEDIA = c4.Z_PK " \
-          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 " \
-          " ORDER BY note_id "
+          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 "
   query2 = " SELECT n.Z_11FOLDERS as folder_id , n.Z_8NOTES as note_id, d.ZDATA as data, " \
           " c2.ZTITLE2 as folder, c2.ZDATEFORLASTTITLEMODIFICATION as folder_title_modified, " \
           " c1.ZCREATIONDATE as created, c1.ZMODIFICATIONDATE1 as modified, c1.ZSNIPPET as snippet, c1.ZTITLE1 as title, c1.ZACCOUNT2 as acc_id, " \
@@ -338,51 +787,94 @@ def ReadNotes(db, source, user, css, odb, blob_path):
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c2 ON c2.Z_PK = n.Z_11FOLDERS " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c3 ON c3.ZNOTE = n.Z_8NOTES " \
           " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c4 ON c3.ZMEDIA = c4.Z_PK " \
-          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 " \
-          " ORDER BY note_id "
-  cursor, error1 = ExecuteQuery(db, query1)
+          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c5 ON c5.Z_PK = c1.ZACCOUNT2 "
+  prepass1 = " SELECT n.Z_9NOTES, c1.ZMODIFICATIONDATE1 FROM Z_12NOTES as n " \
+          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c1 ON c1.Z_PK = n.Z_9NOTES "
+  prepass2 = " SELECT n.Z_8NOTES, c1.ZMODIFICATIONDATE1 FROM Z_11NOTES as n " \
+          " LEFT JOIN ZICCLOUDSYNCINGOBJECT as c1 ON c1.Z_PK = n.Z_8NOTES "
+  if timer is not None:
+    started = timing.clock()
+  cursor, error1 = ExecuteNoteQuery(db, query1, fingerprints, prepass1, "n.Z_9NOTES")
   if cursor:
-    ReadQueryResults(cursor, user, source, css, attachments, odb)
+    if timer is not None:
+      timer.add('query', timing.clock() - started)
+    ReadQueryResults(cursor, user, source, css, attachments, odb, workers, fingerprints, cache, timer, max_size, renderer, plain_text)
   else: # Try query2
-    cursor, error2 = ExecuteQuery(db, query2)
+    cursor, error2 = ExecuteNoteQuery(db, query2, fingerprints, prepass2, "n.Z_8NOTES")
     if cursor:
-      ReadQueryResults(cursor, user, source, css, attachments, odb)
+      if timer is not None:
+        timer.add('query', timing.clock() - started)
+      ReadQueryResults(cursor, user, source, css, attachments, odb, workers, fingerprints, cache, timer, max_size, renderer, plain_text)
     else:
       _log_error('Query execution failed.\n Query 1 error: {}\n Query 2 error: {}'.format(error1, error2))
 
-def ReadNotesV2_V4_V6(db, version, source, user, odb):
+class FolderAccounts:
+  '''Memo of NotesVx.storedata folder -> (folder name, account email, description, user name).
+
+  A note's account is the account of its folder's parent folder.
+  '''
+
+  def __init__(self, db):
+    self.db = db
+    self.folders = {}
+
+  def get(self, folder_id):
+    folder = self.folders.get(folder_id)
+    if folder is None:
+      row = self.db.execute("SELECT f.ZNAME, ac.ZEMAILADDRESS, ac.ZACCOUNTDESCRIPTION, ac.ZUSERNAME "\
+                            " FROM ZFOLDER as f "\
+                            " LEFT JOIN ZFOLDER as parent ON parent.Z_PK = f.ZPARENT "\
+                            " LEFT JOIN ZACCOUNT as ac ON ac.Z_PK = parent.ZACCOUNT "\
+                            " WHERE f.Z_PK = ?", (folder_id,)).fetchone()
+      if row is None:
+        folder = (None, None, None, None)
+      else:
+        folder = tuple(row)
+      self.folders[folder_id] = folder
+    return folder
+
+def ReadNotesV2_V4_V6(db, version, source, user, odb, plain_text=False):
   '''Reads NotesVx.storedata, where x= 2,4,6,7'''
+  # The body is stored as HTML; its text is extracted once per note
+  text = (None, None)
+  folders = FolderAccounts(db)
+  # Attachment rows often repeat the same file URL plist
+  att_paths = {}
   try:
     query = "SELECT n.Z_PK as note_id, n.ZDATECREATED as created, n.ZDATEEDITED as edited, n.ZTITLE as title, "\
-            " (SELECT ZNAME from ZFOLDER where n.ZFOLDER=ZFOLDER.Z_PK) as folder, "\
-            " (SELECT zf2.ZACCOUNT from ZFOLDER as zf1  LEFT JOIN ZFOLDER as zf2 on (zf1.ZPARENT=zf2.Z_PK) where n.ZFOLDER=zf1.Z_PK) as folder_parent_id, "\
-            " ac.ZEMAILADDRESS as email, ac.ZACCOUNTDESCRIPTION as acc_desc, ac.ZUSERNAME as username, b.ZHTMLSTRING as data, "\
+            " n.ZFOLDER as folder_id, b.ZHTMLSTRING as data, "\
             " att.ZCONTENTID as att_id, att.ZFILEURL as file_url "\
             " FROM ZNOTE as n "\
             " LEFT JOIN ZNOTEBODY as b ON b.ZNOTE = n.Z_PK "\
-            " LEFT JOIN ZATTACHMENT as att ON att.ZNOTE = n.Z_PK "\
-            " LEFT JOIN ZACCOUNT as ac ON ac.Z_PK = folder_parent_id"
+            " LEFT JOIN ZATTACHMENT as att ON att.ZNOTE = n.Z_PK"
     db.row_factory = sqlite3.Row
     cursor = db.execute(query)
     for row in cursor:
       try:
+        folder, email, acc_desc, username = folders.get(row['folder_id'])
         att_path = ''
         if row['file_url'] != None:
-          att_path = ReadAttPathFromPlist(row['file_url'])
+          att_path = att_paths.get(row['file_url'])
+          if att_path is None:
+            att_path = att_paths[row['file_url']] = ReadAttPathFromPlist(row['file_url'])
 
         columns = {}
         columns["apple_id"] = row['note_id']
         columns["apple_title"] = row['title']
         columns["apple_snippet"] = ''
-        columns["apple_folder"] = row['folder']
+        columns["apple_folder"] = folder
         columns["apple_created"] = ReadMacAbsoluteTime(row['created'])
         columns["apple_last_modified"] = ReadMacAbsoluteTime(row['edited'])
         columns["apple_data"] = row['data']
+        if plain_text:
+          if text[0] != row['note_id']:
+            text = (row['note_id'], common.html_to_text(row['data']) if row['data'] else '')
+          columns["apple_text"] = text[1]
         columns["apple_attachment_id"] = row['att_id']
         columns["apple_attachment_path"] = att_path
-        columns["apple_account_description"] = row['acc_desc']
-        columns["apple_account_identifier"] = row['email']
-        columns["apple_account_username"] = row['username']
+        columns["apple_account_description"] = acc_desc
+        columns["apple_account_identifier"] = email
+        columns["apple_account_username"] = username
         columns["apple_version"] = 'NoteStore'
         columns["apple_user"] = user
         columns["apple_source"] = source
@@ -406,8 +898,8 @@ def _get_option_parser():
                       action="store", dest="user_name", default=None,
                       help="User name")
     parser.add_option("", "--input",
-                      action="store", dest="input_path", default=None,
-                      help="Path to input Notes SQLite file")
+                      action="append", dest="input_paths", default=None,
+                      help="Path to input Notes SQLite file, or directory searched recursively; may be repeated")
     parser.add_option("", "--css",
                       action="store", dest="css_path", default=None,
                       help="Path to CSS file")
@@ -416,10 +908,79 @@ def _get_option_parser():
                       help="Path to output notes SQLite directory")
     parser.add_option("--blob",
                       action="store_true", dest="output_blob", default=False,
-                      help="Write BLOBs to 'blob' directory in output directory")
+                      help="Write BLOBs to a pack in the 'blob' directory in output directory")
+    parser.add_option("", "--batch-size",
+                      action="store", dest="batch_size", type="int", default=1000,
+                      help="Number of notes inserted per transaction")
+    parser.add_option("--incremental",
+                      action="store_true", dest="incremental", default=False,
+                      help="Only re-import notes that changed since the last incremental run")
+    parser.add_option("", "--render-cache",
+                      action="store", dest="render_cache_path", default=None,
+                      help="Path to SQLite file caching rendered note HTML across runs")
+    parser.add_option("", "--render-cache-size",
+                      action="store", dest="render_cache_size", type="int", default=1024,
+                      help="Maximum size of the render cache in MB")
+    parser.add_option("", "--workers",
+                      action="store", dest="workers", type="int", default=0,
+                      help="Number of processes decoding note blobs (0 decodes on the main process)")
+    parser.add_option("", "--jobs",
+                      action="store", dest="jobs", type="int", default=4,
+                      help="Number of input databases read concurrently")
+    parser.add_option("", "--renderer",
+                      action="store", dest="renderer", default="etree",
+                      help="Note body renderer: 'etree' builds an ElementTree, 'stream' writes the HTML in one pass")
+    parser.add_option("", "--simplify-drawings",
+                      action="store", dest="simplify_drawings", type="float", default=0.0,
+                      help="Drop drawing points within this distance of the simplified stroke (0 keeps every point)")
+    parser.add_option("", "--drawing-precision",
+                      action="store", dest="drawing_precision", type="int", default=2,
+                      help="Decimal places of drawing coordinates")
+    parser.add_option("", "--max-note-size",
+                      action="store", dest="max_note_size", type="int", default=256,
+                      help="Size in MB a note blob may inflate to before only its text is read; drawings and tables past it are not rendered")
+    parser.add_option("", "--media-root",
+                      action="store", dest="media_root", default=None,
+                      help="Notes group container holding the Media and FallbackImages directories (default: the user's)")
+    parser.add_option("", "--media-index",
+                      action="store", dest="media_index_path", default=None,
+                      help="Path to JSON file keeping the index of attachment files across runs")
+    parser.add_option("", "--profile",
+                      action="store", dest="profile_path", default=None,
+                      help="Path to JSON file receiving per-stage timings and the slowest notes")
+    parser.add_option("", "--profile-notes",
+                      action="store", dest="profile_notes", type="int", default=20,
+                      help="Number of slowest notes listed in the profile")
+    parser.add_option("", "--input-mmap-size",
+                      action="store", dest="input_mmap_size", type="int", default=256,
+                      help="Size in MB of the memory map used to read each input database (0 disables it)")
+    parser.add_option("", "--input-cache-size",
+                      action="store", dest="input_cache_size", type="int", default=64,
+                      help="Size in MB of the page cache used to read each input database")
+    parser.add_option("", "--input-snapshot",
+                      action="store_true", dest="input_snapshot", default=False,
+                      help="Copy each input database into memory before reading it")
+    parser.add_option("", "--bulk-load",
+                      action="store_true", dest="bulk_load", default=False,
+                      help="Load mac_apt.db without fsyncs and build its indexes at the end")
+    parser.add_option("", "--bulk-load-journal",
+                      action="store", dest="bulk_load_journal", default="WAL",
+                      help="Journal mode used by --bulk-load: 'WAL', or 'OFF' for a new mac_apt.db only")
+    parser.add_option("", "--bulk-load-cache-size",
+                      action="store", dest="bulk_load_cache_size", type="int", default=256,
+                      help="Size in MB of the mac_apt.db page cache used by --bulk-load")
+    parser.add_option("", "--normalized",
+                      action="store_true", dest="normalized", default=False,
+                      help="Create mac_apt.db with one row per note and a NoteAttachments table, read through a Notes view")
+    parser.add_option("", "--compress",
+                      action="store", dest="compress", default=None,
+                      help="Compress the Data column with this codec: 'zlib', or 'zstd' if the zstandard package is installed")
+    parser.add_option("", "--fts",
+                      action="store_true", dest="fts", default=False,
+                      help="Index the plain text of every note in the NoteTextFTS full-text table")
     return parser
 
-def process_note(columns, sqlconn):
+def process_note(columns, writer):
   # note_title
   note_title = ''
   if columns["apple_title"] is None:
@@ -429,8 +990,155 @@ def process_note(columns, sqlconn):
 
   print("processing '%s'" % (note_title,))
 
-  notesdb.add_macapt_note(sqlconn, columns)
-  sqlconn.commit()
+  writer.add(columns)
+
+def IsNotesDatabase(filename):
+  '''Returns True for file names main knows how to read'''
+  if filename.endswith('-wal') or filename.endswith('-shm') or filename.endswith('-journal'):
+    return False
+  if re.match(r'^NotesV[12467]\.storedata$', filename):
+    return True
+  return filename.find('NoteStore') >= 0 and filename.endswith('.sqlite')
+
+def FindNotesDatabases(inputPath):
+  '''Returns the Notes databases under a directory, recursively, in sorted order'''
+  found = []
+  for dirpath, dirnames, filenames in os.walk(inputPath):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      if IsNotesDatabase(filename):
+        found.append(os.path.join(dirpath, filename))
+  return found
+
+class QueuedWriter:
+  '''Forwards the writer calls of one reader thread to the single writer thread.
+
+  Also counts what was written for the per-source summary.
+  '''
+
+  def __init__(self, source, ops, stopped):
+    self.source = source
+    self.ops = ops
+    self.stopped = stopped
+    self.notes = 0
+    self.rows = 0
+    self.last_id = None
+
+  def put(self, op):
+    while True:
+      try:
+        self.ops.put(op, timeout=1)
+        return
+      except queue.Full:
+        if self.stopped.is_set():
+          raise RuntimeError('writer stopped')
+
+  def add(self, columns):
+    if self.rows == 0 or columns["apple_id"] != self.last_id:
+      self.notes += 1
+      self.last_id = columns["apple_id"]
+    self.rows += 1
+    self.put(('add', (columns,)))
+
+  def delete_note(self, source, note_id):
+    self.put(('delete_note', (source, note_id)))
+
+  def delete_source(self, source):
+    self.put(('delete_source', (source,)))
+
+  def set_fingerprint(self, source, note_id, modified, hash_):
+    self.put(('set_fingerprint', (source, note_id, modified, hash_)))
+
+  def delete_fingerprint(self, source, note_id):
+    self.put(('delete_fingerprint', (source, note_id)))
+
+  def set_watermark(self, source, modified):
+    self.put(('set_watermark', (source, modified)))
+
+def ReadSource(macosdbfile, userName, css, writer, blobs, workers, fingerprints, cache, timer=None, maxNoteSize=None, drawing=None, renderer='etree', inputOptions=None, fullText=False, media=None):
+  '''Reads one Notes database; returns dict of counts for the summary'''
+  started = time.time()
+  try:
+    print("input database '%s'" % (macosdbfile,))
+
+    macos_sqlconn = notesinput.connect(macosdbfile, inputOptions)
+    macos_sqlconn.row_factory = sqlite3.Row
+    snapshotPath = None
+
+    filename = os.path.basename(macosdbfile)
+    try:
+      if filename.find('V2') > 0:
+          ReadNotesV2_V4_V6(macos_sqlconn, 'V2', macosdbfile, userName, writer, fullText)
+      elif filename.find('V1') > 0:
+          ReadNotesV2_V4_V6(macos_sqlconn, 'V1', macosdbfile, userName, writer, fullText)
+      elif filename.find('V4') > 0:
+          ReadNotesV2_V4_V6(macos_sqlconn, 'V4', macosdbfile, userName, writer, fullText)
+      elif filename.find('V6') > 0:
+          ReadNotesV2_V4_V6(macos_sqlconn, 'V6', macosdbfile, userName, writer, fullText)
+      elif filename.find('V7') > 0:
+          ReadNotesV2_V4_V6(macos_sqlconn, 'V7', macosdbfile, userName, writer, fullText)
+      elif filename.find('NoteStore') >= 0:
+          inputPath = macosdbfile
+          attachmentOptions = inputOptions
+          if workers > 0 and inputOptions is not None and inputOptions.snapshot:
+            # Workers read attachment data from the same snapshot as the notes
+            snapshotPath = notesinput.snapshot_file(macos_sqlconn)
+            inputPath = snapshotPath
+            attachmentOptions = inputOptions.for_snapshot_file()
+          ReadNotes(macos_sqlconn, macosdbfile, userName, css, writer, blobs, workers, fingerprints, cache, timer, maxNoteSize, drawing, renderer, fullText, media,
+            inputPath, attachmentOptions)
+          if fingerprints is not None:
+            fingerprints.finish(writer)
+      else:
+          _log_error('Unknown database type, not a recognized file name')
+    finally:
+      macos_sqlconn.close()
+      if snapshotPath is not None:
+        os.remove(snapshotPath)
+      if cache is not None:
+        cache.close()
+  finally:
+    # Tell the writer thread this source is done
+    writer.put(None)
+
+  summary = {'notes': writer.notes, 'rows': writer.rows, 'seconds': time.time() - started}
+  if fingerprints is not None:
+    summary['skipped'] = fingerprints.skipped
+  if cache is not None:
+    summary['cache_hits'] = cache.hits
+    summary['cache_misses'] = cache.misses
+  if drawing is not None and not drawing.is_default():
+    summary['drawing_bytes'] = (drawing.original_bytes, drawing.rendered_bytes)
+  return summary
+
+def PrintSummary(sources, results):
+  print("summary:")
+  for source in sources:
+    result = results[source]
+    if isinstance(result, Exception):
+      print("  %s: FAILED (%s: %s)" % (source, type(result).__name__, result))
+      continue
+    line = "  %s: %d note(s), %d row(s)" % (source, result['notes'], result['rows'])
+    if 'skipped' in result:
+      line += ", %d unchanged note(s) skipped" % (result['skipped'],)
+    if 'cache_hits' in result:
+      line += ", render cache %d hit(s) %d miss(es)" % (result['cache_hits'], result['cache_misses'])
+    if 'drawing_bytes' in result:
+      original, rendered = result['drawing_bytes']
+      line += ", drawing paths ~%d -> %d bytes" % (original, rendered)
+      if original > 0:
+        line += " (%.1f%% smaller)" % (100.0 * (original - rendered) / original,)
+      if 'cache_hits' in result:
+        line += " in rendered notes only"
+    line += ", %.2fs" % (result['seconds'],)
+    print(line)
+
+def PrintCompression(writer):
+  line = "compression: %s, Data %d -> %d bytes" % (writer.codec, writer.raw_bytes, writer.stored_bytes)
+  if writer.raw_bytes > 0:
+    line += " (%.1f%% smaller)" % (100.0 * (writer.raw_bytes - writer.stored_bytes) / writer.raw_bytes,)
+  line += ", %.2fs" % (writer.compress_seconds,)
+  print(line)
 
 def main(args):
   parser = _get_option_parser()
@@ -443,16 +1151,33 @@ def main(args):
   else:
     common.error("user name not specified.")
 
-  inputPath = ''
+  sources = []
 
-  if hasattr(options, 'input_path') and options.input_path:
-    inputPath = os.path.abspath(os.path.expanduser(options.input_path))
-    if os.path.isfile(inputPath) == False:
-      # Check if input file exists
-      common.error("input file '%s' does not exist." % (inputPath,))
+  if hasattr(options, 'input_paths') and options.input_paths:
+    for input_path in options.input_paths:
+      inputPath = os.path.abspath(os.path.expanduser(input_path))
+      if os.path.isdir(inputPath):
+        found = FindNotesDatabases(inputPath)
+        if len(found) == 0:
+          common.error("no Notes databases found in '%s'." % (inputPath,))
+        sources.extend(found)
+      elif os.path.isfile(inputPath):
+        if not IsNotesDatabase(os.path.basename(inputPath)):
+          common.error("input file '%s' is not a recognized Notes database." % (inputPath,))
+        sources.append(inputPath)
+      else:
+        # Check if input file exists
+        common.error("input file '%s' does not exist." % (os.path.abspath(inputPath),))
   else:
     common.error("input file not specified.")
 
+  # The same database may be named twice, e.g. once directly and once through
+  # its directory or a symbolic link; read it once, under its first name
+  unique = collections.OrderedDict()
+  for source in sources:
+    unique.setdefault(os.path.realpath(source), source)
+  sources = list(unique.values())
+
   cssPath = ''
 
   if hasattr(options, 'css_path') and options.css_path:
@@ -481,26 +1206,126 @@ def main(args):
   else:
     blobPath = None
 
-  macosdbfile = options.input_path
+  batchSize = options.batch_size
+  if batchSize < 1:
+    common.error("batch size must be at least 1.")
 
-  notesdbfile = os.path.join(options.output_path, 'mac_apt.db')
+  workers = options.workers
+  if workers < 0:
+    common.error("number of workers must not be negative.")
 
-  if not os.path.isfile(macosdbfile):
-    common.error("input file does not exist")
+  jobs = options.jobs
+  if jobs < 1:
+    common.error("number of jobs must be at least 1.")
 
-  new_database = (not os.path.isfile(notesdbfile))
+  cachePath = None
+
+  if hasattr(options, 'render_cache_path') and options.render_cache_path:
+    cachePath = os.path.abspath(os.path.expanduser(options.render_cache_path))
+    if os.path.isdir(os.path.dirname(cachePath)) == False:
+      # Check if render cache directory exists
+      common.error("render cache directory '%s' does not exist." % (os.path.dirname(cachePath),))
+
+  if options.renderer not in RENDERERS:
+    common.error("renderer must be one of: %s." % (', '.join(sorted(RENDERERS)),))
+
+  if options.simplify_drawings < 0:
+    common.error("drawing simplification tolerance must not be negative.")
+  if options.drawing_precision < 0 or options.drawing_precision > 6:
+    common.error("drawing precision must be between 0 and 6.")
 
-  print("input database '%s'" % (macosdbfile,))
+  maxNoteSize = options.max_note_size
+  if maxNoteSize < 1:
+    common.error("maximum note size must be at least 1 MB.")
+  maxNoteSize = maxNoteSize * 1024 * 1024
 
-  macos_sqlconn = sqlite3.connect(macosdbfile) #,
-  #  detect_types=sqlite3.PARSE_DECLTYPES)
-  macos_sqlconn.row_factory = sqlite3.Row
+  if options.input_mmap_size < 0:
+    common.error("input memory map size must not be negative.")
+  if options.input_cache_size < 1:
+    common.error("input cache size must be at least 1 MB.")
+  inputOptions = notesinput.InputOptions(options.input_mmap_size * notesinput.MB,
+    options.input_cache_size * notesinput.MB, options.input_snapshot)
+
+  codec = options.compress
+  if codec is not None and codec not in notesdb.available_codecs():
+    common.error("compression codec must be one of: %s." % (', '.join(notesdb.available_codecs()),))
+
+  profilePath = None
+
+  if hasattr(options, 'profile_path') and options.profile_path:
+    profilePath = os.path.abspath(os.path.expanduser(options.profile_path))
+    if os.path.isdir(os.path.dirname(profilePath)) == False:
+      # Check if profile directory exists
+      common.error("profile directory '%s' does not exist." % (os.path.dirname(profilePath),))
+
+  timer = None
+  if profilePath is not None:
+    timer = timing.StageTimer(options.profile_notes)
+
+  mediaRoot = GroupContainer(userName)
+
+  if hasattr(options, 'media_root') and options.media_root:
+    mediaRoot = os.path.abspath(os.path.expanduser(options.media_root))
+    if os.path.isdir(mediaRoot) == False:
+      # Check if media root directory exists
+      common.error("media root directory '%s' does not exist." % (mediaRoot,))
+
+  mediaIndexPath = None
+
+  if hasattr(options, 'media_index_path') and options.media_index_path:
+    mediaIndexPath = os.path.abspath(os.path.expanduser(options.media_index_path))
+    if os.path.isdir(os.path.dirname(mediaIndexPath)) == False:
+      # Check if media index directory exists
+      common.error("media index directory '%s' does not exist." % (os.path.dirname(mediaIndexPath),))
+
+  # List the attachment files once for every source instead of a stat per
+  # attachment, when the first attachment is rendered
+  media = mediaindex.LazyMediaIndex(mediaRoot, mediaIndexPath, timer)
+
+  notesdbfile = os.path.join(options.output_path, 'mac_apt.db')
+
+  new_database = (not os.path.isfile(notesdbfile))
+
+  bulkJournal = options.bulk_load_journal.upper()
+  if options.bulk_load:
+    if bulkJournal not in notesdb.BulkLoad.JOURNAL_MODES:
+      common.error("bulk load journal mode must be one of: %s." % (', '.join(notesdb.BulkLoad.JOURNAL_MODES),))
+    if bulkJournal == 'OFF' and not new_database:
+      # Without a journal an interrupted load can corrupt the existing rows
+      common.error("bulk load journal mode OFF requires a new output database.")
+    if options.bulk_load_cache_size < 1:
+      common.error("bulk load cache size must be at least 1 MB.")
 
   sqlconn = sqlite3.connect(notesdbfile,
     detect_types=sqlite3.PARSE_DECLTYPES)
 
+  normalized = options.normalized
   if (new_database):
-    notesdb.create_macapt_database(sqlconn=sqlconn)
+    if normalized:
+      notesdb.create_macapt_normalized_database(sqlconn=sqlconn, indexes=not options.bulk_load)
+    else:
+      notesdb.create_macapt_database(sqlconn=sqlconn, indexes=not options.bulk_load)
+  elif notesdb.is_macapt_normalized(sqlconn):
+    # The schema of an existing database is kept
+    normalized = True
+  else:
+    if normalized:
+      common.error("output database '%s' does not have the normalized schema." % (notesdbfile,))
+    notesdb.migrate_macapt_database(sqlconn)
+
+  fullText = options.fts or notesdb.has_macapt_fts_tables(sqlconn)
+  if fullText:
+    # An existing index is kept in step even when --fts is not given
+    if not notesdb.has_fts5(sqlconn):
+      common.error("full-text search needs an SQLite library built with FTS5.")
+    notesdb.create_macapt_fts_tables(sqlconn)
+
+  bulkLoad = None
+  if options.bulk_load:
+    # Only a new database has its indexes built after the load
+    bulkLoad = notesdb.BulkLoad(sqlconn, notesdb.NORMALIZED_INDEXES if normalized else notesdb.MACAPT_INDEXES, bulkJournal,
+      options.bulk_load_cache_size * 1024 * 1024, defer_indexes=new_database)
+    bulkLoad.begin()
 
   if cssPath == '':
     css = DefaultCss()
@@ -508,24 +1333,98 @@ def main(args):
     css = loadfile(cssPath)
 
   if sqlconn != None:
-    filename = os.path.basename(macosdbfile)
-    if filename.find('V2') > 0:
-        ReadNotesV2_V4_V6(macos_sqlconn, 'V2', macosdbfile, userName, sqlconn)
-    elif filename.find('V1') > 0:
-        ReadNotesV2_V4_V6(macos_sqlconn, 'V1', macosdbfile, userName, sqlconn)
-    elif filename.find('V4') > 0:
-        ReadNotesV2_V4_V6(macos_sqlconn, 'V4', macosdbfile, userName, sqlconn)
-    elif filename.find('V6') > 0:
-        ReadNotesV2_V4_V6(macos_sqlconn, 'V6', macosdbfile, userName, sqlconn)
-    elif filename.find('V7') > 0:
-        ReadNotesV2_V4_V6(macos_sqlconn, 'V7', macosdbfile, userName, sqlconn)
-    elif filename.find('NoteStore') >= 0:
-        ReadNotes(macos_sqlconn, macosdbfile, userName, css, sqlconn, blobPath)
-    else:
-        _log_error('Unknown database type, not a recognized file name')
-    sqlconn.commit()
+    writer = notesdb.MacAptNoteBatch(sqlconn, batchSize, timer, normalized, codec, fullText)
+
+    # Incremental state is read before the readers start; afterwards only the writer thread touches sqlconn
+    fingerprints = {}
+    if options.incremental:
+      notesdb.create_macapt_sync_tables(sqlconn)
+      for macosdbfile in sources:
+        filename = os.path.basename(macosdbfile)
+        watermark = notesdb.get_source_watermark(sqlconn, macosdbfile)
+        if watermark is None or filename.find('NoteStore') < 0:
+          # First incremental run (or a NotesVx.storedata file): replace every row of this source
+          writer.delete_source(macosdbfile)
+        if filename.find('NoteStore') >= 0:
+          fingerprints[macosdbfile] = NoteFingerprints(macosdbfile,
+            notesdb.get_note_fingerprints(sqlconn, macosdbfile),
+            None if watermark is None else watermark[0], watermark is None)
+      writer.flush()
+
+    ops = queue.Queue(maxsize=batchSize * 2)
+    stopped = threading.Event()
+    results = {}
+    blobs = None
+    if blobPath is not None:
+      blobs = blobpack.BlobPackWriter(blobPath)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+      futures = {}
+      for macosdbfile in sources:
+        cache = None
+        if cachePath is not None:
+          cache = rendercache.RenderCache(cachePath, options.render_cache_size * 1024 * 1024, RENDERER_VERSION)
+        futures[macosdbfile] = pool.submit(ReadSource, macosdbfile, userName, css,
+          QueuedWriter(macosdbfile, ops, stopped), blobs, workers, fingerprints.get(macosdbfile), cache, timer, maxNoteSize,
+          DrawingOptions(options.simplify_drawings, options.drawing_precision), options.renderer, inputOptions, fullText, media)
+
+      # Single writer: apply the readers' writes in the order they were queued
+      remaining = len(sources)
+      while remaining > 0:
+        op = ops.get()
+        if op is None:
+          remaining -= 1
+          continue
+        name, op_args = op
+        getattr(writer, name)(*op_args)
+    except:
+      stopped.set()
+      raise
+    finally:
+      # Commit the last partial batch
+      writer.flush()
+      pool.shutdown(wait=True)
+      if blobs is not None:
+        blobs.close()
+      if bulkLoad is not None:
+        if timer is not None:
+          started = timing.clock()
+        bulkLoad.finish()
+        if timer is not None:
+          timer.add('finish_load', timing.clock() - started)
+
+    for macosdbfile in sources:
+      try:
+        results[macosdbfile] = futures[macosdbfile].result()
+      except Exception as ex:
+        results[macosdbfile] = ex
     sqlconn.close()
 
+    if blobs is not None:
+      # Drop the blobs this run superseded: those of sources read in full
+      # again, of notes written again and of notes deleted from their source
+      replaced = []
+      deleted = []
+      for macosdbfile in sources:
+        if isinstance(results[macosdbfile], Exception):
+          continue
+        fingerprint = fingerprints.get(macosdbfile)
+        if fingerprint is None or fingerprint.first_run:
+          replaced.append(macosdbfile)
+        else:
+          deleted.extend((macosdbfile, note_id) for note_id in fingerprint.deleted)
+      size, compacted = blobpack.compact(blobPath, replaced, blobs.start, deleted)
+      if compacted != size:
+        print("blob pack: %d bytes compacted to %d bytes" % (size, compacted))
+
+    PrintSummary(sources, results)
+    if codec is not None:
+      PrintCompression(writer)
+    if timer is not None:
+      timer.write(profilePath)
+    failed = [source for source in sources if isinstance(results[source], Exception)]
+    if len(failed) > 0:
+      common.error("%d of %d input database(s) failed." % (len(failed), len(sources)))
+
 if __name__ == "__main__":
   main(sys.argv[1:])
-
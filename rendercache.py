@@ -0,0 +1,155 @@
+import sqlite3
+import hashlib
+import json
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Persistent cache of rendered note HTML, stored in a sidecar SQLite file.
+#
+# Entries are keyed by a hash of the renderer version, the CSS, the attachment
+# root and the decompressed note blob. Each entry also records a digest of every
+# attachment the note looked up while it was rendered; a hit is only used if
+# those attachments are unchanged in the source being read.
+#
+
+class DependencyRecorder:
+  '''Wraps an Attachments map and records the digest of every attachment looked up'''
+
+  def __init__(self, attachments):
+    self.attachments = attachments
+    self.used = {}
+
+  def get(self, id, default=None):
+    self.used[id] = self.attachments.digest(id)
+    return self.attachments.get(id, default)
+
+class RenderCache:
+  '''Content-addressed cache of rendered note HTML.
+
+  Instances are pickled to decode workers; each process opens its own
+  connection on first use. Only the main process should call store, touch
+  and close.
+  '''
+
+  def __init__(self, path, max_bytes, version):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.version = version
+    self.hits = 0
+    self.misses = 0
+    self.evicted = 0
+    self.sqlconn = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['sqlconn'] = None
+    return state
+
+  def connect(self):
+    if self.sqlconn is None:
+      self.sqlconn = sqlite3.connect(self.path, timeout=60)
+      self.sqlconn.execute('''PRAGMA journal_mode=WAL;''')
+      # Every note is committed on its own; in WAL mode NORMAL only syncs at checkpoints
+      self.sqlconn.execute('''PRAGMA synchronous=NORMAL;''')
+      self.sqlconn.execute('''CREATE TABLE IF NOT EXISTS "RenderCache" (
+  "Key"  TEXT,
+  "Html"  BLOB,
+  "Dependencies"  TEXT,
+  "Size"  INTEGER,
+  "LastUsed"  INTEGER,
+  PRIMARY KEY("Key")
+  );''')
+      self.sqlconn.execute('''CREATE INDEX IF NOT EXISTS "lastusedidx" ON "RenderCache" (
+    "LastUsed"
+  );''')
+      self.sqlconn.commit()
+    return self.sqlconn
+
+  def key(self, blob, css, context):
+    h = hashlib.sha256()
+    for part in (self.version, css, context):
+      h.update(part.encode('utf8'))
+      h.update(b'\0')
+    h.update(blob)
+    return h.hexdigest()
+
+  def lookup(self, key, attachments):
+    '''Returns the cached HTML, or None if missing or an attachment it used has changed'''
+    row = self.connect().execute('''SELECT Html, Dependencies FROM RenderCache WHERE Key = ?;''', (key,)).fetchone()
+    if row is None:
+      return None
+    for id, digest in json.loads(row[1]).items():
+      if attachments.digest(id) != digest:
+        return None
+    return row[0]
+
+  def record(self, result):
+    '''Counts a decode result; result is ('hit', key) or ('miss', key, html, dependencies)'''
+    if result[0] == 'hit':
+      self.hits += 1
+      self.touch(result[1])
+    else:
+      self.misses += 1
+      self.store(*result[1:])
+    # Several sources may share the cache file; holding the write lock
+    # across notes would block their readers
+    self.commit()
+
+  def store(self, key, html, dependencies):
+    self.connect().execute('''INSERT OR REPLACE INTO RenderCache (Key, Html, Dependencies, Size, LastUsed)
+  VALUES (?, ?, ?, ?, strftime('%s', 'now'));''', (key, html, json.dumps(dependencies), len(html)))
+
+  def touch(self, key):
+    self.connect().execute('''UPDATE RenderCache SET LastUsed = strftime('%s', 'now') WHERE Key = ?;''', (key,))
+
+  def evict(self):
+    '''Deletes the least recently used entries until the cache fits in max_bytes'''
+    sqlconn = self.connect()
+    total = sqlconn.execute('''SELECT ifnull(sum(Size), 0) FROM RenderCache;''').fetchone()[0]
+    if total <= self.max_bytes:
+      return
+    victims = []
+    for key, size in sqlconn.execute('''SELECT Key, Size FROM RenderCache ORDER BY LastUsed, rowid;'''):
+      if total <= self.max_bytes:
+        break
+      victims.append((key,))
+      total -= size
+    sqlconn.executemany('''DELETE FROM RenderCache WHERE Key = ?;''', victims)
+    self.evicted += len(victims)
+
+  def commit(self):
+    if self.sqlconn is not None:
+      self.sqlconn.commit()
+
+  def close(self):
+    self.evict()
+    self.sqlconn.commit()
+    self.sqlconn.close()
+    self.sqlconn = None
+    print("render cache '%s': %d hit(s), %d miss(es), %d evicted" % (self.path, self.hits, self.misses, self.evicted))
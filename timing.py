@@ -0,0 +1,114 @@
+import array
+import heapq
+import json
+import threading
+import time
+
+#
+# MIT License
+#
+# https://opensource.org/licenses/MIT
+#
+# Copyright 2020 Rene Sugar
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Description:
+#
+# Per-stage timing for readnotes --profile.
+#
+# Code being timed takes an optional timer (or, for the note decoder, a plain
+# dict of stage -> seconds that can be sent back from a worker process) and
+# only reads the clock when it is not None, so nothing is measured unless
+# profiling was asked for.
+#
+
+clock = time.perf_counter
+
+def percentile(ordered, fraction):
+  '''Nearest-rank percentile of an already sorted sequence'''
+  if len(ordered) == 0:
+    return None
+  rank = int(round(fraction * (len(ordered) - 1)))
+  return ordered[rank]
+
+class StageTimer:
+  '''Collects the elapsed time of every stage sample and the slowest notes.
+
+  Safe to share between reader threads.
+  '''
+
+  def __init__(self, slowest=20):
+    self.slowest = slowest
+    self.samples = {}
+    self.notes = []
+    self.lock = threading.Lock()
+    self.started = clock()
+
+  def add(self, stage, seconds):
+    with self.lock:
+      samples = self.samples.get(stage)
+      if samples is None:
+        samples = self.samples[stage] = array.array('d')
+      samples.append(seconds)
+
+  def merge(self, timings):
+    '''Adds a dict of stage -> seconds, e.g. the timings of one decoded note'''
+    for stage, seconds in timings.items():
+      self.add(stage, seconds)
+
+  def note(self, source, note_id, seconds, timings=None):
+    '''Records the total time spent on one note; only the slowest are kept'''
+    entry = (seconds, str(source), str(note_id), dict(timings or {}))
+    with self.lock:
+      if len(self.notes) < self.slowest:
+        heapq.heappush(self.notes, entry)
+      elif seconds > self.notes[0][0]:
+        heapq.heapreplace(self.notes, entry)
+
+  def report(self):
+    stages = {}
+    for stage, samples in sorted(self.samples.items()):
+      ordered = sorted(samples)
+      stages[stage] = {
+        'count': len(ordered),
+        'total': sum(ordered),
+        'p50': percentile(ordered, 0.50),
+        'p95': percentile(ordered, 0.95),
+        'max': ordered[-1],
+      }
+    notes = []
+    for seconds, source, note_id, timings in sorted(self.notes, reverse=True):
+      notes.append({'source': source, 'note_id': note_id, 'seconds': seconds, 'stages': timings})
+    return {
+      'wall_seconds': clock() - self.started,
+      'stages': stages,
+      'slowest_notes': notes,
+    }
+
+  def write(self, path):
+    report = self.report()
+    with open(path, 'w') as f:
+      json.dump(report, f, indent=2)
+      f.write('\n')
+    print("profile: written to '%s'" % (path,))
+    for stage, stats in report['stages'].items():
+      print("  %-14s %8d  total %9.3fs  p50 %8.3fms  p95 %8.3fms  max %8.3fms" % (stage, stats['count'],
+        stats['total'], stats['p50'] * 1000, stats['p95'] * 1000, stats['max'] * 1000))